@@ -0,0 +1,141 @@
+import os, json, re, time, tempfile
+from css_utils import Log, Result, get_cache_path
+
+CACHE_VERSION = 1
+BLOB_CACHE_SIZE = 128 * 1024 * 1024
+
+class BlobCache:
+    '''On-disk cache of downloaded theme blobs keyed by download id, plus theme db metadata with its ETag.
+    Blobs are evicted least recently used first once the cache grows over maxSize'''
+    def __init__(self, cachePath : str, maxSize : int = BLOB_CACHE_SIZE):
+        self.cachePath = cachePath
+        self.indexPath = os.path.join(cachePath, "index.json")
+        self.maxSize = maxSize
+        self.blobs = {}
+        self.meta = {}
+        self.in_use = {}
+        self.loaded = False
+
+    def load(self):
+        if self.loaded:
+            return
+
+        self.loaded = True
+        os.makedirs(self.cachePath, exist_ok=True)
+
+        if not os.path.exists(self.indexPath):
+            return
+
+        try:
+            with open(self.indexPath, "r") as fp:
+                data = json.load(fp)
+
+            if data.get("version") == CACHE_VERSION:
+                self.blobs = {x: data["blobs"][x] for x in data["blobs"] if os.path.exists(self._blob_path(x))}
+                self.meta = data["meta"]
+        except Exception as e:
+            Log(f"[Warn] Failed to read blob cache index: {str(e)}")
+
+    def save(self) -> Result:
+        try:
+            tempPath = self.indexPath + ".tmp"
+            with open(tempPath, "w") as fp:
+                json.dump({"version": CACHE_VERSION, "blobs": self.blobs, "meta": self.meta}, fp)
+
+            os.replace(tempPath, self.indexPath)
+        except Exception as e:
+            return Result(False, f"Failed to write blob cache index: {str(e)}")
+
+        return Result(True)
+
+    def _blob_path(self, blobId : str) -> str:
+        return os.path.join(self.cachePath, re.sub(r"[^A-Za-z0-9_.-]", "_", blobId) + ".zip")
+
+    def get_meta(self, id : str) -> dict | None:
+        self.load()
+        return self.meta.get(id)
+
+    def put_meta(self, id : str, etag : str | None, data : dict):
+        self.load()
+
+        if etag is None:
+            self.meta.pop(id, None)
+        else:
+            self.meta[id] = {"etag": etag, "data": data}
+
+        self.save()
+
+    def get_blob(self, blobId : str) -> str | None:
+        self.load()
+
+        if blobId not in self.blobs:
+            return None
+
+        path = self._blob_path(blobId)
+
+        if not os.path.exists(path):
+            del self.blobs[blobId]
+            return None
+
+        self.blobs[blobId]["used"] = time.time()
+        self.in_use[blobId] = self.in_use.get(blobId, 0) + 1
+        self.save()
+        return path
+
+    def get_download_path(self, blobId : str) -> str:
+        '''A new temp file in the cache folder, so concurrent downloads of the same blob don't share one'''
+        self.load()
+        (fd, path) = tempfile.mkstemp(prefix=os.path.basename(self._blob_path(blobId)) + ".", suffix=".part", dir=self.cachePath)
+        os.close(fd)
+        return path
+
+    def add_blob(self, blobId : str, downloadPath : str) -> str:
+        '''Moves a finished download from get_download_path into the cache. Like get_blob, the blob stays in use until released'''
+        path = self._blob_path(blobId)
+        os.replace(downloadPath, path)
+        self.blobs[blobId] = {"size": os.path.getsize(path), "used": time.time()}
+        self.in_use[blobId] = self.in_use.get(blobId, 0) + 1
+        self.evict()
+        self.save()
+        return path
+
+    def release(self, blobId : str):
+        if blobId in self.in_use:
+            self.in_use[blobId] -= 1
+
+            if self.in_use[blobId] <= 0:
+                del self.in_use[blobId]
+
+    def discard(self, blobId : str):
+        '''Drops a blob that turned out to be unusable'''
+        self.blobs.pop(blobId, None)
+
+        try:
+            os.remove(self._blob_path(blobId))
+        except OSError:
+            pass
+
+        Log(f"Discarded blob {blobId} from cache")
+        self.save()
+
+    def evict(self):
+        total = sum([self.blobs[x]["size"] for x in self.blobs])
+
+        for x in sorted(self.blobs, key=lambda d: self.blobs[d]["used"]):
+            if total <= self.maxSize:
+                break
+
+            if x in self.in_use:
+                continue
+
+            total -= self.blobs[x]["size"]
+            del self.blobs[x]
+
+            try:
+                os.remove(self._blob_path(x))
+            except OSError:
+                pass
+
+            Log(f"Evicted blob {x} from cache")
+
+BLOB_CACHE = BlobCache(get_cache_path())
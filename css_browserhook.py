@@ -1,9 +1,185 @@
-import os, re, uuid, asyncio, json, aiohttp, time
-from typing import List
-from css_utils import get_theme_path, Log, Result
-import css_inject
+import os, re, asyncio, aiohttp, time, hashlib, contextlib, contextvars
+from typing import List, Dict, Tuple, Callable
+from css_utils import get_theme_path, Log, Result, store_or_file_config, emit_event
 
 MAX_QUEUE_SIZE = 500
+DEFAULT_COMMAND_TIMEOUT = 5
+COMMAND_TIMEOUTS = {
+    "Target.setDiscoverTargets": 10,
+    "Target.attachToTarget": 10,
+}
+HEALTH_CHECK_INTERVAL = 30
+LIFECYCLE_DEBOUNCE = 0.1
+TAB_UPDATE_DEBOUNCE = 0.25
+BUNDLE_ID = "css-loader-bundle"
+LIFECYCLE_EVENTS = ["Page.frameNavigated", "Page.loadEventFired", "Runtime.executionContextCreated", "Runtime.bindingCalled"]
+PRELOAD_BINDING = "cssLoaderPreload"
+
+TAB_MATCHERS : Dict[str, Callable] = {} # Compiled matchers for every tab name used by an inject
+INDEXED_INJECTS : list = []
+MATCHER_CACHE : Dict[str, Callable] = {}
+TAB_PATTERNS_READY = asyncio.Event() # Set once the first theme list has been indexed
+
+CSS_HELPER_JS = """
+(function() {
+    // Bundle mode: every style is a range of rules in one stylesheet, cssLoaderSegments keeps the [id, rule count] of each range in order
+    const applyBundle = (add, remove, hash) => {
+        let style = document.getElementById('%BUNDLE_ID%');
+
+        if (style !== null && style.cssLoaderSegments === undefined) {
+            style.remove();
+            style = null;
+        }
+
+        if (style === null) {
+            style = document.createElement('style');
+            style.id = '%BUNDLE_ID%';
+            style.classList.add('css-loader-style');
+            style.cssLoaderSegments = [];
+            document.head.append(style);
+        }
+
+        const sheet = style.sheet;
+        const segments = style.cssLoaderSegments;
+        const offsetOf = (index) => segments.slice(0, index).reduce((a, x) => a + x[1], 0);
+
+        remove.forEach(id => {
+            const index = segments.findIndex(x => x[0] === id);
+            if (index < 0) {
+                return;
+            }
+
+            const offset = offsetOf(index);
+            for (let i = 0; i < segments[index][1]; i++) {
+                sheet.deleteRule(offset);
+            }
+
+            segments.splice(index, 1);
+        });
+
+        // Sorted by their final position, so everything in front of them is already in place
+        add.forEach(x => {
+            const parsed = new CSSStyleSheet();
+            parsed.replaceSync(x.css);
+
+            const offset = offsetOf(x.index);
+            let count = 0;
+
+            for (const rule of parsed.cssRules) {
+                try {
+                    sheet.insertRule(rule.cssText, offset + count);
+                    count++;
+                } catch (e) {}
+            }
+
+            segments.splice(x.index, 0, [x.id, count]);
+        });
+
+        if (segments.length <= 0) {
+            style.remove();
+        } else {
+            style.dataset.hash = hash;
+        }
+    };
+
+    return function(add, remove, removeAll, bundleHash) {
+        if (removeAll) {
+            document.querySelectorAll('.css-loader-style').forEach(x => x.remove());
+        }
+
+        if (bundleHash !== null) {
+            applyBundle(add, remove, bundleHash);
+            return true;
+        }
+
+        add.forEach(x => {
+            let existing = document.getElementById(x.id);
+            if (existing !== null) {
+                if (existing.textContent !== x.css) {
+                    existing.textContent = x.css;
+                }
+
+                if (x.hash) {
+                    existing.dataset.hash = x.hash;
+                }
+
+                return;
+            }
+
+            let style = document.createElement('style');
+            style.id = x.id;
+            style.classList.add('css-loader-style');
+
+            if (x.hash) {
+                style.dataset.hash = x.hash;
+            }
+
+            document.head.append(style);
+            style.textContent = x.css;
+        });
+
+        remove.forEach(x => {
+            let style = document.getElementById(x);
+            style?.parentNode.removeChild(style);
+        });
+
+        return true;
+    };
+})()
+""".replace("%BUNDLE_ID%", BUNDLE_ID)
+
+# Registered once per tab. It only tells us a new top level document has a head, the css is then sent through the css helper
+PRELOAD_JS = """
+(function() {
+    if (window !== window.top) {
+        return;
+    }
+
+    const request = () => window.%BINDING%?.("");
+
+    if (document.head) {
+        request();
+        return;
+    }
+
+    const observer = new MutationObserver(() => {
+        if (document.head) {
+            observer.disconnect();
+            request();
+        }
+    });
+
+    observer.observe(document, {childList: true, subtree: true});
+})()
+""".replace("%BINDING%", PRELOAD_BINDING)
+
+def get_css_id(css : str) -> str:
+    return "css-" + hashlib.sha1(css.encode("utf-8")).hexdigest()[:20]
+
+def compile_tab_name(tab_name : str) -> Callable:
+    if tab_name.startswith("~") and tab_name.endswith("~") and len(tab_name) > 2:
+        url = tab_name[1:-1]
+        return lambda tab: url in tab.url
+    elif tab_name.startswith("!"):
+        html_class = tab_name[1:]
+        return lambda tab: html_class in tab.html_classes
+    
+    try:
+        regex = re.compile(f"^({tab_name})$")
+    except re.error as e:
+        Result(False, f"Invalid tab name '{tab_name}': {str(e)}")
+        return lambda tab: False
+
+    return lambda tab: regex.match(tab.title) != None
+
+def get_tab_matcher(tab_name : str) -> Callable:
+    if tab_name in TAB_MATCHERS:
+        return TAB_MATCHERS[tab_name]
+
+    if tab_name not in MATCHER_CACHE:
+        MATCHER_CACHE[tab_name] = compile_tab_name(tab_name)
+
+    return MATCHER_CACHE[tab_name]
 
 class BrowserTabHook:
     def __init__(self, browserHook, sessionId : str, targetInfo : dict):
@@ -17,18 +193,136 @@ class BrowserTabHook:
         self.pending_remove = []
         self.init_done = False
         self.html_classes = []
+        self.styles = {}
+        self.style_owners : Dict[str, set] = {}
+        self.priorities = {}
+        self.match_key = None
+        self.matched_patterns = set()
+        self.matching_injects = []
+        self.match_dirty = False
+        self.match_update_task = None
+        self.css_helper_id = None
+        self.commit_lock = asyncio.Lock()
+        self.expect_document = False
+        self.lifecycle_queue = asyncio.Queue(maxsize=MAX_QUEUE_SIZE)
+
+        for x in LIFECYCLE_EVENTS:
+            self.hook.subscribe(x, self.sessionId, self.lifecycle_queue)
+
+        self.lifecycle_task = asyncio.create_task(self.on_lifecycle_event())
         asyncio.create_task(self._init())
 
     async def _init(self):
-        res = await self.evaluate_js("(function(){ return {\"title\": document.title, \"classes\": Array.from(document.documentElement.classList)} })()")
+        try:
+            await self.hook.send_command("Page.enable", {}, self.sessionId)
+            await self.hook.send_command("Runtime.enable", {}, self.sessionId)
+            await self.hook.send_command("Runtime.addBinding", {"name": PRELOAD_BINDING}, self.sessionId)
+            await self.hook.send_command("Page.addScriptToEvaluateOnNewDocument", {"source": PRELOAD_JS}, self.sessionId)
+        except Exception as e:
+            Result(False, f"[Lifecycle events on {self.title}] {str(e)}")
+
+        res = await self.evaluate_js(f"""
+            (function() {{
+                if (document.getElementById("test_css_loaded") === null) {{
+                    const elem = document.createElement('div');
+                    elem.id = "test_css_loaded";
+                    document.head.append(elem);
+                }}
+
+                return {{
+                    "title": document.title,
+                    "classes": Array.from(document.documentElement.classList),
+                    "styles": Array.from(document.querySelectorAll('.css-loader-style')).map(x => ({{"id": x.id, "hash": x.dataset.hash ?? x.id}}))
+                }};
+            }})()
+            """)
 
         if res != None:
             self.title = res["title"]
             self.html_classes = res["classes"]
 
+        # During startup tabs can attach before the themes are indexed
+        await TAB_PATTERNS_READY.wait()
+
+        self.update_matches()
         self.init_done = True
-        Log(f"Connected to tab: {self.title}")
-        await self.health_check()
+        Log(f"Connected to tab: {self.title} ({time.time() - self.hook.start_time:.3f}s after hook start)")
+        emit_event("tab_attached", {"id": self.id, "title": self.title})
+
+        if res == None:
+            await self.health_check()
+            return
+
+        # After a reconnect the page usually still has our styles, only send what differs
+        existing = {}
+        for x in res["styles"]:
+            existing[x["id"]] = x["hash"]
+
+        try:
+            await self.force_reinject(existing)
+        except Exception as e:
+            Result(False, f"[Reattach on {self.title}] {str(e)}")
+
+    def close(self):
+        for x in LIFECYCLE_EVENTS:
+            self.hook.unsubscribe(x, self.lifecycle_queue)
+
+        self.lifecycle_task.cancel()
+
+    def is_lifecycle_trigger(self, message : dict) -> bool:
+        method = message["method"]
+        params = message["params"]
+
+        if method == "Page.frameNavigated" and "parentId" in params["frame"]:
+            return False
+
+        if method == "Runtime.executionContextCreated" and not params["context"].get("auxData", {}).get("isDefault", False):
+            return False
+
+        if method == "Runtime.bindingCalled":
+            # Any page in the tab can call the binding, it only counts once per new document
+            if params["name"] != PRELOAD_BINDING or not self.expect_document:
+                return False
+
+            self.expect_document = False
+            return True
+
+        if method in ["Page.frameNavigated", "Runtime.executionContextCreated"]:
+            self.expect_document = True
+
+        return True
+
+    async def on_lifecycle_event(self):
+        while True:
+            message = await self.lifecycle_queue.get()
+
+            if not self.is_lifecycle_trigger(message):
+                continue
+
+            self.css_helper_id = None
+
+            # A navigation fires several of these in a row, one check covers all of them.
+            # The preload binding means the new document has a head, so it ends the wait early
+            deadline = time.monotonic() + LIFECYCLE_DEBOUNCE
+            preloaded = message["method"] == "Runtime.bindingCalled"
+
+            while not preloaded:
+                remaining = deadline - time.monotonic()
+
+                if remaining <= 0:
+                    break
+
+                try:
+                    message = await asyncio.wait_for(self.lifecycle_queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+
+                preloaded = self.is_lifecycle_trigger(message) and message["method"] == "Runtime.bindingCalled"
+
+            try:
+                await self.health_check()
+            except Exception as e:
+                Result(False, f"[Health Check on {self.title}] {str(e)}")
 
     async def evaluate_js(self, js, run_async=False, get_result=True):
         try:
@@ -55,51 +349,127 @@ class BrowserTabHook:
 
         return res
     
-    async def has_element(self, element_name):
-        res = await self.evaluate_js(f"document.getElementById('{element_name}') != null")
+    def update_matches(self, force : bool = False) -> bool:
+        key = (self.title, self.url, tuple(self.html_classes))
+
+        if not force and key == self.match_key:
+            return False
+        
+        self.match_key = key
+        old_patterns = self.matched_patterns
+        self.matched_patterns = set([x for x in TAB_MATCHERS if TAB_MATCHERS[x](self)])
+        self.matching_injects = [x for x in INDEXED_INJECTS if not self.matched_patterns.isdisjoint(x.tabs)]
+        self.hook.update_pattern_index(self, old_patterns, self.matched_patterns)
+        return True
+
+    def add_matches(self, injects : list, new_patterns : list):
+        if self.match_key == None:
+            return
 
-        return res if res != None else False
+        old_patterns = self.matched_patterns
+        self.matched_patterns = old_patterns | set([x for x in new_patterns if TAB_MATCHERS[x](self)])
+        self.matching_injects = self.matching_injects + [x for x in injects if not self.matched_patterns.isdisjoint(x.tabs)]
+        self.hook.update_pattern_index(self, old_patterns, self.matched_patterns)
+
+    def schedule_match_update(self):
+        self.match_dirty = True
+
+        if self.match_update_task == None or self.match_update_task.done():
+            self.match_update_task = asyncio.create_task(self.apply_match_update())
+
+    async def apply_match_update(self):
+        while self.match_dirty:
+            await asyncio.sleep(TAB_UPDATE_DEBOUNCE)
+            self.match_dirty = False
+
+            old_injects = self.matching_injects
+
+            if not self.update_matches():
+                continue
+
+            added = [x for x in self.matching_injects if x.enabled and x not in old_injects]
+            removed = [x for x in old_injects if x.enabled and x not in self.matching_injects]
+
+            if len(added) + len(removed) <= 0:
+                continue
+
+            Log(f"Matching injects of {self.title} changed +{len(added)} -{len(removed)}")
+
+            for x in removed:
+                await x.remove_from_tab(self)
+
+            for x in added:
+                await x.inject_with_tab(self)
+
+            await self.commit_css_transaction()
 
     def compare(self, tab_name : str) -> bool:
-        if tab_name.startswith("~") and tab_name.endswith("~") and len(tab_name) > 2:
-            if tab_name[1:-1] in self.url:
-                return True
-        elif tab_name.startswith("!"):
-            if tab_name[1:] in self.html_classes:
-                return True
-        elif re.match(f"^({tab_name})$", self.title):
-            return True
-        
-        return False
+        if tab_name in TAB_MATCHERS:
+            return tab_name in self.matched_patterns
+
+        return get_tab_matcher(tab_name)(self)
     
-    async def force_reinject(self) -> Result:
-        for inject in css_inject.ALL_INJECTS:
+    async def force_reinject(self, existing : Dict[str, str] = None) -> Result:
+        async with self.commit_lock:
+            return await self._force_reinject(existing)
+
+    async def _force_reinject(self, existing : Dict[str, str] = None) -> Result:
+        self.pending_add = {}
+        self.pending_remove = []
+        self.style_owners = {}
+        self.priorities = {}
+        self.styles = {}
+
+        for inject in self.matching_injects:
             if inject.enabled:
-                for x in inject.tabs:
-                    if self.compare(x):
-                        await inject.inject_with_tab(self)
-                        break
+                await inject.inject_with_tab(self)
+
+        if existing == None:
+            return await self._commit_css_transaction(remove_all_first=True)
+
+        if self.hook.bundle_css:
+            if existing.get(BUNDLE_ID) != self.get_bundle_hash(self.get_bundle_order(self.pending_add)) or len(existing) > 1:
+                return await self._commit_css_transaction(remove_all_first=True)
 
-        await self.commit_css_transaction(remove_all_first=True)    
+            self.styles = self.pending_add
+            self.pending_add = {}
+        else:
+            for x in list(self.pending_add):
+                if x in existing:
+                    self.styles[x] = self.pending_add.pop(x)
+
+            self.pending_remove = [x for x in existing if x not in self.style_owners]
+
+        Log(f"Reconciled {self.title}: {len(self.styles)} style(s) kept, +{len(self.pending_add)} -{len(self.pending_remove)}")
+
+        if len(self.pending_add) + len(self.pending_remove) <= 0:
+            return Result(True)
+
+        return await self._commit_css_transaction()
 
     async def health_check(self) -> Result:
         if not self.init_done:
             return Result(True)
 
         try:
-            if not await self.has_element("test_css_loaded"):
-                await self.evaluate_js(
-                    f"""
-                    (function() {{
-                        const elem = document.createElement('div');
-                        elem.id = "test_css_loaded";
-                        document.head.append(elem);
-                    }})()
-                    """) 
-                
-                if not await self.has_element("test_css_loaded"):
-                    raise Exception("a variable was injected but cannot be found when retrieved")
-                
+            res = await self.evaluate_js(
+                f"""
+                (function() {{
+                    if (document.getElementById("test_css_loaded") !== null) {{
+                        return true;
+                    }}
+
+                    const elem = document.createElement('div');
+                    elem.id = "test_css_loaded";
+                    document.head.append(elem);
+                    return false;
+                }})()
+                """)
+
+            if res == None:
+                raise Exception("Failed to check for test element")
+
+            if not res:
                 await self.force_reinject()
 
         except Exception as e:
@@ -107,77 +477,135 @@ class BrowserTabHook:
         
         return Result(True)
     
-    async def inject_css(self, css : str, id : str = None) -> Result:
+    def get_bundle_order(self, styles : dict) -> List[str]:
+        return sorted(styles, key=lambda x: (self.priorities.get(x, (0, 0)), x))
+
+    def get_bundle_hash(self, order : List[str]) -> str:
+        # Style ids are content hashes, so the ordered ids identify the bundle contents
+        return get_css_id("\n".join(order))
+
+    async def get_css_helper(self) -> str|None:
+        if self.css_helper_id != None:
+            return self.css_helper_id
+
+        res = await self.hook.send_command("Runtime.evaluate", {
+            "expression": CSS_HELPER_JS,
+            "returnByValue": False,
+            }, self.sessionId)
+
+        if res != None and "result" in res and "objectId" in res["result"]["result"]:
+            self.css_helper_id = res["result"]["result"]["objectId"]
+
+        return self.css_helper_id
+
+    async def call_css_helper(self, add : list, remove : list, remove_all : bool = False, bundle_hash : str = None) -> bool:
+        # Css is passed as call arguments, so the page never has to parse it as script source
+        for _ in range(2):
+            try:
+                helper = await self.get_css_helper()
+
+                if helper == None:
+                    return False
+
+                res = await self.hook.send_command("Runtime.callFunctionOn", {
+                    "functionDeclaration": "function(add, remove, removeAll, bundleHash) { return this(add, remove, removeAll, bundleHash); }",
+                    "objectId": helper,
+                    "arguments": [{"value": add}, {"value": remove}, {"value": remove_all}, {"value": bundle_hash}],
+                    "returnByValue": True,
+                    }, self.sessionId)
+            except Exception as e:
+                Result(False, f"[Css Helper on {self.title}] {str(e)}")
+                return False
+
+            if res != None and "result" in res and "exceptionDetails" not in res["result"]:
+                return True
+
+            # The helper belonged to an execution context that no longer exists
+            self.css_helper_id = None
+
+        return False
+
+    async def inject_css(self, css : str, id : str = None, priority : tuple = (0, 0), owner = None) -> Result:
         if id == None:
-            id = str(uuid.uuid4())
+            id = get_css_id(css)
+
+        if id not in self.style_owners:
+            self.style_owners[id] = set()
+            self.priorities[id] = priority
+
+            if id in self.pending_remove:
+                self.pending_remove.remove(id)
+            elif id not in self.styles:
+                self.pending_add[id] = css
 
-        self.pending_add[id] = css
+        # Identical css from several injects is only sent once, it stays until the last owner removes it
+        self.style_owners[id].add(owner)
+        self.priorities[id] = min(self.priorities[id], priority)
         return Result(True, id)
     
-    async def remove_css(self, css_id : str) -> Result:
+    async def remove_css(self, css_id : str, owner = None) -> Result:
+        if css_id in self.style_owners:
+            self.style_owners[css_id].discard(owner)
+
+            if len(self.style_owners[css_id]) > 0:
+                return Result(True)
+
+            del self.style_owners[css_id]
+
         if css_id in self.pending_add:
             del self.pending_add[css_id]
-        else:
+            self.priorities.pop(css_id, None)
+        elif css_id not in self.pending_remove:
             self.pending_remove.append(css_id)
 
         return Result(True)
 
     async def commit_css_transaction(self, retry : int = 3, remove_all_first : bool = False) -> Result:
+        # Commits build on self.styles, so they run one at a time per tab
+        async with self.commit_lock:
+            return await self._commit_css_transaction(retry, remove_all_first)
+
+    async def _commit_css_transaction(self, retry : int = 3, remove_all_first : bool = False) -> Result:
         pending_add = self.pending_add
         pending_remove = self.pending_remove
 
-        if len(pending_add) + len(pending_remove) == 0:
+        if len(pending_add) + len(pending_remove) == 0 and not remove_all_first:
             return Result(True)
 
         self.pending_add = {}
         self.pending_remove = []
         Log(f"Committing css transaction on {self.title} +{len(pending_add)} -{len(pending_remove)}")
 
-        data = {
-            "add": [{"id": x, "css": pending_add[x]} for x in pending_add],
-            "remove": pending_remove
-        }
-
-        try:
-            data_str = json.dumps(data)
-        except Exception as e:
-            Result(False, str(e))
-
-        extra_js = ""
-
-        if remove_all_first:
-            extra_js = "document.querySelectorAll('.css-loader-style').forEach(x => x.remove());"
+        styles = {} if remove_all_first else dict(self.styles)
+        styles.update(pending_add)
 
-        js = f"""
-        (function() {{
-            let css_data = {data_str};
+        for x in pending_remove:
+            styles.pop(x, None)
 
-            {extra_js}
+        bundle_hash = None
 
-            css_data.add.forEach(x => {{
-                if (document.getElementById(x.id) !== null){{
-                    return;
-                }}
-
-                let style = document.createElement('style');
-	            style.id = x.id;
-                style.classList.add('css-loader-style');
-	            document.head.append(style);
-	            style.textContent = x.css;
-            }});
-            
-            css_data.remove.forEach(x => {{
-                let style = document.getElementById(x);
-                style?.parentNode.removeChild(style);
-            }});
-        }})()
-        """
+        if self.hook.bundle_css:
+            # All styles of this tab live in one stylesheet ordered by theme priority, only the changed rule ranges are sent
+            order = self.get_bundle_order(styles)
+            bundle_hash = self.get_bundle_hash(order)
+            add = [{"id": x, "css": styles[x], "index": i} for (i, x) in enumerate(order) if remove_all_first or x in pending_add]
+            remove = [] if remove_all_first else pending_remove
+        else:
+            add = [{"id": x, "css": pending_add[x]} for x in pending_add]
+            remove = pending_remove
 
         while (retry > 0):
+            if not self.hook.is_connected():
+                return Result(False, "Websocket not opened")
+
             retry -= 1
-            res = await self.evaluate_js(js)
-            if res != None:
-                return res
+            if await self.call_css_helper(add, remove, remove_all_first, bundle_hash):
+                for x in self.styles:
+                    if x not in styles:
+                        self.priorities.pop(x, None)
+
+                self.styles = styles
+                return Result(True)
             else:
                 Log("Transaction failed! retrying in 0.2 seconds")
                 await asyncio.sleep(0.2)
@@ -185,20 +613,23 @@ class BrowserTabHook:
         return Result(False, "Css Commit Retry Count Exceeded")
     
     async def remove_all_css(self, retry : int = 3) -> Result:
-        js = """
-        (function() {
-            document.querySelectorAll('.css-loader-style').forEach(x => x.remove());
-        })()
-        """
+        async with self.commit_lock:
+            return await self._remove_all_css(retry)
 
+    async def _remove_all_css(self, retry : int = 3) -> Result:
         self.pending_add = {}
         self.pending_remove = []
+        self.style_owners = {}
 
         while (retry > 0):
+            if not self.hook.is_connected():
+                return Result(False, "Websocket not opened")
+
             retry -= 1
-            res = await self.evaluate_js(js)
-            if res != None:
-                return res
+            if await self.call_css_helper([], [], True):
+                self.styles = {}
+                self.priorities = {}
+                return Result(True)
             else:
                 Log("Transaction failed! retrying in 0.2 seconds")
                 await asyncio.sleep(0.2)
@@ -212,9 +643,19 @@ class BrowserHook:
         self.websocket = None
         self.current_id = 0
         self.ws_url = None
-        self.ws_response : List[asyncio.Queue] = []
+        self.pending_responses : Dict[int, asyncio.Future] = {}
+        self.event_subscribers : Dict[str, List[Tuple[str|None, asyncio.Queue]]] = {}
+        self.dropped_messages = 0
+        self.unmatched_responses = 0
+        self.max_backlog = 0
         self.connected_tabs : List[BrowserTabHook] = []
+        self.pattern_tabs : Dict[str, set] = {}
         self.tab_names = {}
+        self.bundle_css = store_or_file_config("bundle_css")
+        self.start_time = time.time()
+
+        if self.bundle_css:
+            Log("Bundling css into a single style element per tab")
 
         asyncio.create_task(self.on_new_tab())
         asyncio.create_task(self.on_tab_update())
@@ -232,7 +673,12 @@ class BrowserHook:
         self.websocket = await self.client.ws_connect(self.ws_url)
 
     async def close_websocket(self):
+        for x in self.connected_tabs:
+            x.close()
+
         self.connected_tabs.clear()
+        self.pattern_tabs.clear()
+        self.fail_pending_responses("Websocket closed")
         await self.websocket.close()
         await self.client.close() 
         self.websocket = None 
@@ -241,7 +687,86 @@ class BrowserHook:
     def is_connected(self) -> bool:
         return self.websocket != None and not self.websocket.closed
 
-    async def send_command(self, method : str, params : dict, sessionId : str|None, await_response : bool = True):
+    def update_pattern_index(self, tab : BrowserTabHook, old_patterns : set, new_patterns : set):
+        for x in old_patterns - new_patterns:
+            if x in self.pattern_tabs:
+                self.pattern_tabs[x].discard(tab)
+
+        for x in new_patterns - old_patterns:
+            if x not in self.pattern_tabs:
+                self.pattern_tabs[x] = set()
+
+            self.pattern_tabs[x].add(tab)
+
+    def fail_pending_responses(self, reason : str):
+        pending = self.pending_responses
+        self.pending_responses = {}
+
+        for id in pending:
+            if not pending[id].done():
+                pending[id].set_exception(ConnectionError(reason))
+
+        if len(pending) > 0:
+            Log(f"Failed {len(pending)} in-flight request(s): {reason}")
+
+    def subscribe(self, method : str, sessionId : str|None = None, queue : asyncio.Queue = None) -> asyncio.Queue:
+        if queue == None:
+            queue = asyncio.Queue(maxsize=MAX_QUEUE_SIZE)
+
+        if method not in self.event_subscribers:
+            self.event_subscribers[method] = []
+
+        self.event_subscribers[method].append((sessionId, queue))
+        return queue
+
+    def unsubscribe(self, method : str, queue : asyncio.Queue):
+        if method not in self.event_subscribers:
+            return
+
+        self.event_subscribers[method] = [x for x in self.event_subscribers[method] if x[1] is not queue]
+
+        if len(self.event_subscribers[method]) <= 0:
+            del self.event_subscribers[method]
+
+    def dispatch(self, message : dict):
+        if "id" in message:
+            future = self.pending_responses.pop(message["id"], None)
+
+            if future == None or future.done():
+                self.unmatched_responses += 1
+            else:
+                future.set_result(message)
+
+            return
+
+        if "method" not in message or message["method"] not in self.event_subscribers:
+            return
+        
+        sessionId = message.get("sessionId")
+
+        for (subscribed_session, queue) in self.event_subscribers[message["method"]]:
+            if subscribed_session != None and subscribed_session != sessionId:
+                continue
+
+            if queue.full():
+                self.dropped_messages += 1
+                Log(f"[Warn] Dropped {message['method']} event, subscriber queue is full ({self.dropped_messages} dropped total)")
+                continue
+
+            queue.put_nowait(message)
+            self.max_backlog = max(self.max_backlog, queue.qsize())
+
+    def get_stats(self) -> dict:
+        return {
+            "pending_responses": len(self.pending_responses),
+            "subscribers": sum([len(self.event_subscribers[x]) for x in self.event_subscribers]),
+            "backlog": sum([queue.qsize() for x in self.event_subscribers for (_, queue) in self.event_subscribers[x]]),
+            "max_backlog": self.max_backlog,
+            "dropped_messages": self.dropped_messages,
+            "unmatched_responses": self.unmatched_responses,
+        }
+
+    async def send_command(self, method : str, params : dict, sessionId : str|None, await_response : bool = True, timeout : float = None):
         if self.is_connected():
             id = self.get_id()
             data = {
@@ -253,102 +778,89 @@ class BrowserHook:
             if sessionId != None:
                 data["sessionId"] = sessionId
 
-            if await_response:
-                queue = asyncio.Queue(maxsize=MAX_QUEUE_SIZE)
-                self.ws_response.append(queue)
-
-            await self.websocket.send_json(data)
-
-            start_time = time.time()
-
-            while await_response:
-                result = await queue.get()
-
-                if (start_time + 5) < time.time():
-                    Result(False, f"Request for {method} took more than 5s. Assuming it failed")
-                    self.ws_response.remove(queue)
-                    del queue
-                    return None
-                
-                if "id" in result and result["id"] == id:
-                    self.ws_response.remove(queue)
-                    del queue
-                    return result          
-                
-            return None
+            if not await_response:
+                await self.websocket.send_json(data)
+                return None
+
+            if timeout == None:
+                timeout = COMMAND_TIMEOUTS.get(method, DEFAULT_COMMAND_TIMEOUT)
+
+            future = asyncio.get_running_loop().create_future()
+            self.pending_responses[id] = future
+
+            try:
+                await self.websocket.send_json(data)
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                Result(False, f"Request for {method} took more than {timeout}s. Assuming it failed")
+                return None
+            finally:
+                self.pending_responses.pop(id, None)
+
         raise RuntimeError("Websocket not opened")   
     
     async def on_new_tab(self):
-        queue = asyncio.Queue(maxsize=MAX_QUEUE_SIZE)
-        self.ws_response.append(queue) 
+        queue = self.subscribe("Target.targetCreated")
 
         while True:
             message = await queue.get()
-            
-            if "method" in message and message["method"] == "Target.targetCreated":
-                if message["params"]["targetInfo"]["type"] != "page":
-                    continue
 
-                await self.send_command("Target.attachToTarget", {"targetId": message["params"]["targetInfo"]["targetId"], "flatten": True}, None, False)
+            if message["params"]["targetInfo"]["type"] != "page":
+                continue
+
+            await self.send_command("Target.attachToTarget", {"targetId": message["params"]["targetInfo"]["targetId"], "flatten": True}, None, False)
 
     async def on_tab_update(self):
-        queue = asyncio.Queue(maxsize=MAX_QUEUE_SIZE)
-        self.ws_response.append(queue) 
+        queue = self.subscribe("Target.targetInfoChanged")
 
         while True:
-            message = await queue.get()     
-
-            if "method" in message and message["method"] == "Target.targetInfoChanged":
-                target_info = message["params"]["targetInfo"]
+            message = await queue.get()
+            target_info = message["params"]["targetInfo"]
 
-                for connected_tab in self.connected_tabs:
-                    if target_info["targetId"] == connected_tab.id:
-                        reinject = False
+            for connected_tab in self.connected_tabs:
+                if target_info["targetId"] == connected_tab.id:
+                    changed = False
 
-                        if (target_info["title"] != connected_tab.title):
-                            connected_tab.title = target_info["title"]
-                            reinject = True
+                    if (target_info["title"] != connected_tab.title):
+                        connected_tab.title = target_info["title"]
+                        changed = True
 
-                        if (target_info["url"] != connected_tab.url):
-                            connected_tab.url = target_info["url"]
-                            reinject = True
+                    if (target_info["url"] != connected_tab.url):
+                        connected_tab.url = target_info["url"]
+                        changed = True
 
-                        if reinject:
-                            asyncio.create_task(connected_tab.force_reinject())
+                    if changed:
+                        connected_tab.schedule_match_update()
 
-                        found = True
-                        break
+                    break
     
     async def on_tab_attach(self):
-        queue = asyncio.Queue(maxsize=MAX_QUEUE_SIZE)
-        self.ws_response.append(queue) 
+        queue = self.subscribe("Target.attachedToTarget")
 
         while True:
-            message = await queue.get()    
-
-            if "method" in message and message["method"] == "Target.attachedToTarget":
-                self.connected_tabs.append(BrowserTabHook(self, message["params"]["sessionId"], message["params"]["targetInfo"]))
+            message = await queue.get()
+            self.connected_tabs.append(BrowserTabHook(self, message["params"]["sessionId"], message["params"]["targetInfo"]))
     
     async def on_tab_detach(self):
-        queue = asyncio.Queue(maxsize=MAX_QUEUE_SIZE)
-        self.ws_response.append(queue) 
+        queue = self.subscribe("Target.detachedFromTarget")
 
         while True:
             message = await queue.get()
+            targetId = message["params"]["targetId"]
 
-            if "method" in message and message["method"] == "Target.detachedFromTarget":    
-                targetId = message["params"]["targetId"]
-
-                tab = None
+            tab = None
 
-                for x in self.connected_tabs:
-                    if x.id == targetId:
-                        tab = x
-                        break
-                
-                if tab != None:
-                    Log(f"Disconnected from tab: {tab.title}")
-                    self.connected_tabs.remove(tab)
+            for x in self.connected_tabs:
+                if x.id == targetId:
+                    tab = x
+                    break
+            
+            if tab != None:
+                Log(f"Disconnected from tab: {tab.title}")
+                emit_event("tab_detached", {"id": tab.id, "title": tab.title})
+                tab.close()
+                self.update_pattern_index(tab, tab.matched_patterns, set())
+                self.connected_tabs.remove(tab)
 
     async def css_health_check(self):
         while True:
@@ -358,11 +870,17 @@ class BrowserHook:
                 except Exception as e:
                     Result(False, f"[Health Check on {tab.title}] {str(e)}")
 
-            await asyncio.sleep(3)  
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)  
 
     async def health_check(self):
+        first_attempt = True
+
         while True:
-            await asyncio.sleep(3)
+            if not first_attempt:
+                await asyncio.sleep(3)
+
+            first_attempt = False
+
             try:
                 async with aiohttp.ClientSession() as web:
                     res = await web.get(f"http://localhost:8080/json/version", timeout=3)
@@ -374,18 +892,17 @@ class BrowserHook:
                 self.ws_url = data["webSocketDebuggerUrl"]
 
                 await self.open_websocket()
-                Log("Connected to Steam Browser")
+                Log(f"Connected to Steam Browser ({time.time() - self.start_time:.3f}s after hook start)")
                 await self.send_command("Target.setDiscoverTargets", {"discover": True}, None, False)
 
                 async for message in self.websocket:
-                    data = message.json()
-                    for x in self.ws_response:
-                        if not x.full():
-                            x.put_nowait(data)
+                    self.dispatch(message.json())
 
             except Exception as e:
                 Log(f"[Browser Health Check] {str(e)}")
 
+            Log(f"[Browser Health Check] Dispatcher stats: {self.get_stats()}")
+
             try:
                 await self.close_websocket()
             except:
@@ -397,33 +914,92 @@ async def initialize():
     global HOOK
     HOOK = BrowserHook()
 
-def get_tabs(tab_name : str) -> List[BrowserTabHook]:
-    tabs = []
+def compile_tab_patterns(injects : list):
+    TAB_MATCHERS.clear()
+    INDEXED_INJECTS.clear()
+    INDEXED_INJECTS.extend(injects)
 
-    for tab in HOOK.connected_tabs:
-        if tab.compare(tab_name):
-            tabs.append(tab)
+    for inject in injects:
+        for x in inject.tabs:
+            if x not in TAB_MATCHERS:
+                TAB_MATCHERS[x] = get_tab_matcher(x)
+
+    MATCHER_CACHE.clear()
+    TAB_PATTERNS_READY.set()
+    
+    if HOOK != None:
+        for tab in HOOK.connected_tabs:
+            tab.update_matches(True)
+
+def add_tab_patterns(injects : list):
+    new_patterns = []
+
+    for inject in injects:
+        INDEXED_INJECTS.append(inject)
+
+        for x in inject.tabs:
+            if x not in TAB_MATCHERS:
+                TAB_MATCHERS[x] = get_tab_matcher(x)
+                new_patterns.append(x)
+
+    if HOOK != None:
+        for tab in HOOK.connected_tabs:
+            tab.add_matches(injects, new_patterns)
+
+def get_tabs(tab_name : str) -> List[BrowserTabHook]:
+    if tab_name in TAB_MATCHERS:
+        tabs = list(HOOK.pattern_tabs.get(tab_name, set()))
+    else:
+        tabs = [x for x in HOOK.connected_tabs if x.compare(tab_name)]
 
     if tabs == []:
         Log(f"[Warn] get_tabs({tab_name}) returned []. All tabs: {str([x.title for x in HOOK.connected_tabs])}")
     
     return tabs
 
-async def inject(tab_name : str, css : str) -> Result:
-    id = str(uuid.uuid4())
+async def inject(tab_name : str, css : str, priority : tuple = (0, 0), owner = None) -> Result:
+    id = get_css_id(css)
     for tab in get_tabs(tab_name):
-        await tab.inject_css(css, id)
+        await tab.inject_css(css, id, priority, owner)
     
     return Result(True, id)
 
-async def remove(tab_name : str, css_id : str) -> Result:
+async def remove(tab_name : str, css_id : str, owner = None) -> Result:
     for tab in get_tabs(tab_name):
-        await tab.remove_css(css_id)
+        await tab.remove_css(css_id, owner)
     
     return Result(True)
 
+BATCH : contextvars.ContextVar = contextvars.ContextVar("css_loader_batch", default=None)
+
 async def commit_all():
+    batch = BATCH.get()
+
+    if batch is not None and batch["open"]:
+        batch["pending"] = True
+        return
+
     await asyncio.gather(*[x.commit_css_transaction() for x in HOOK.connected_tabs])
 
+@contextlib.asynccontextmanager
+async def batch_commits():
+    '''Holds back commit_all calls made from within the batch (this task and the tasks it starts) until it ends,
+    then commits once if anything asked for it. Commits from anywhere else go through as usual'''
+    if BATCH.get() is not None and BATCH.get()["open"]:
+        yield
+        return
+
+    batch = {"open": True, "pending": False}
+    token = BATCH.set(batch)
+
+    try:
+        yield
+    finally:
+        batch["open"] = False
+        BATCH.reset(token)
+
+        if batch["pending"]:
+            await commit_all()
+
 async def remove_all():
     await asyncio.gather(*[x.remove_all_css() for x in HOOK.connected_tabs])
\ No newline at end of file
@@ -0,0 +1,172 @@
+import heapq
+from typing import List, Dict
+from css_utils import Log
+
+class DependencyGraph:
+    '''Dependency graph of all loaded themes, built once per load'''
+    def __init__(self, themes : list):
+        self.themes = {}
+        self.edges : Dict[str, List[str]] = {}
+        self.cycles = []
+
+        for x in themes:
+            if x.name not in self.themes:
+                self.themes[x.name] = x
+
+        for name in self.themes:
+            self.edges[name] = [x for x in self.themes[name].dependencies if x in self.themes and x != name]
+
+        self._break_cycles()
+        self.refresh_refcounts()
+
+    def _break_cycles(self):
+        # Iterative DFS, any edge back into the current path closes a cycle and is dropped
+        state = {}
+
+        for root in self.themes:
+            if root in state:
+                continue
+
+            state[root] = 1
+            stack = [(root, 0)]
+
+            while len(stack) > 0:
+                (name, i) = stack[-1]
+
+                if i >= len(self.edges[name]):
+                    state[name] = 2
+                    stack.pop()
+                    continue
+
+                stack[-1] = (name, i + 1)
+                dependency = self.edges[name][i]
+
+                if state.get(dependency) == 1:
+                    self.cycles.append((name, dependency))
+                    Log(f"[Warn] Dependency cycle between '{name}' and '{dependency}', ignoring '{name}' -> '{dependency}'")
+                    self.edges[name] = [x for x in self.edges[name] if x != dependency]
+                    stack[-1] = (name, i)
+                elif dependency not in state:
+                    state[dependency] = 1
+                    stack.append((dependency, 0))
+
+    def refresh_refcounts(self):
+        '''Recount how many enabled themes depend on each theme'''
+        self.refcounts = {x: 0 for x in self.themes}
+        self.counted = set()
+
+        for name in self.themes:
+            self.update(self.themes[name])
+
+    def update(self, theme):
+        if theme.name not in self.themes or (theme.name in self.counted) == theme.enabled:
+            return
+
+        change = 1 if theme.enabled else -1
+
+        if theme.enabled:
+            self.counted.add(theme.name)
+        else:
+            self.counted.remove(theme.name)
+
+        for x in self.edges[theme.name]:
+            self.refcounts[x] += change
+
+    def get_disable_plan(self, name : str, keep_dependencies : bool = False) -> list:
+        '''The theme and every enabled dependency no other enabled theme still needs'''
+        plan = [self.themes[name]]
+
+        if keep_dependencies:
+            return plan
+
+        refcounts = dict(self.refcounts)
+        disabled = set([name])
+        queue = [name]
+
+        while len(queue) > 0:
+            current = queue.pop(0)
+
+            for x in self.edges[current]:
+                if current in self.counted:
+                    refcounts[x] -= 1
+
+                if refcounts[x] <= 0 and x not in disabled and self.themes[x].enabled:
+                    disabled.add(x)
+                    plan.append(self.themes[x])
+                    queue.append(x)
+
+        return plan
+
+    def get(self, name : str):
+        return self.themes.get(name)
+
+    def get_load_order(self) -> list:
+        '''Every theme after its dependencies, ties are broken by priority modifier and then name'''
+        remaining = {}
+        dependents = {}
+
+        for name in self.themes:
+            remaining[name] = len(self.edges[name])
+            for x in self.edges[name]:
+                if x not in dependents:
+                    dependents[x] = []
+
+                dependents[x].append(name)
+
+        ready = [(self.themes[x].priority_mod, x) for x in self.themes if remaining[x] == 0]
+        heapq.heapify(ready)
+        order = []
+
+        while len(ready) > 0:
+            (_, name) = heapq.heappop(ready)
+            order.append(self.themes[name])
+
+            for x in dependents.get(name, []):
+                remaining[x] -= 1
+                if remaining[x] == 0:
+                    heapq.heappush(ready, (self.themes[x].priority_mod, x))
+
+        return order
+
+    def get_enable_plan(self, name : str) -> list:
+        '''All dependencies of a theme, each once, dependencies first. The theme itself is last'''
+        plan = []
+        visited = set([name])
+        stack = [(name, 0)]
+
+        while len(stack) > 0:
+            (current, i) = stack[-1]
+
+            if i >= len(self.edges[current]):
+                plan.append(self.themes[current])
+                stack.pop()
+                continue
+
+            stack[-1] = (current, i + 1)
+            dependency = self.edges[current][i]
+
+            if dependency not in visited:
+                visited.add(dependency)
+                stack.append((dependency, 0))
+
+        return plan
+
+    def get_dependency_values(self, name : str, include_root : bool = True) -> Dict[str, dict]:
+        '''Patch values each dependency should get. The dependent closest to the enabled theme wins'''
+        values = {}
+        visited = set([name])
+        queue = [name]
+
+        while len(queue) > 0:
+            current = queue.pop(0)
+            dependencies = self.themes[current].dependencies
+
+            for x in self.edges[current]:
+                if x not in values and (include_root or current != name):
+                    values[x] = dependencies[x] if isinstance(dependencies, dict) else {}
+
+                if x not in visited:
+                    visited.add(x)
+                    queue.append(x)
+
+        return values
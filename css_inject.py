@@ -1,9 +1,91 @@
+import os, hashlib
+from collections import OrderedDict
 from typing import List
 from css_utils import Result, Log
-from css_browserhook import BrowserTabHook as CssTab, inject, remove
-import uuid
+from css_browserhook import BrowserTabHook as CssTab, inject, remove, add_tab_patterns
 
 ALL_INJECTS = []
+CSS_CACHE_BUDGET = 32 * 1024 * 1024
+
+class CssFileCache:
+    '''Process-wide cache of css file contents, invalidated by mtime/size and bounded by a byte budget'''
+    def __init__(self, budget : int):
+        self.budget = budget
+        self.entries = OrderedDict() # path -> (stat key, content hash, size)
+        self.contents = {} # content hash -> [css, reference count]
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted_bytes = 0
+
+    def read(self, cssPath : str) -> str:
+        stat = os.stat(cssPath)
+        key = (stat.st_mtime_ns, stat.st_size)
+        entry = self.entries.get(cssPath)
+
+        if entry != None and entry[0] == key:
+            self.hits += 1
+            self.entries.move_to_end(cssPath)
+            return self.contents[entry[1]][0]
+
+        self.misses += 1
+
+        with open(cssPath, "r") as fp:
+            css = fp.read()
+
+        css = css.replace("\\", "\\\\").replace("`", "\\`")
+
+        if entry != None:
+            self.drop(cssPath)
+
+        # Identical files are stored once and handed out as the same string
+        content_hash = hashlib.sha1(css.encode("utf-8")).hexdigest()
+
+        if content_hash in self.contents:
+            self.contents[content_hash][1] += 1
+            css = self.contents[content_hash][0]
+        else:
+            self.contents[content_hash] = [css, 1]
+            self.size += len(css)
+
+        self.entries[cssPath] = (key, content_hash, len(css))
+        self.evict()
+        return css
+
+    def drop(self, cssPath : str):
+        (_, content_hash, size) = self.entries.pop(cssPath)
+        self.contents[content_hash][1] -= 1
+
+        if self.contents[content_hash][1] <= 0:
+            del self.contents[content_hash]
+            self.size -= size
+            return size
+
+        return 0
+
+    def evict(self):
+        while self.size > self.budget and len(self.entries) > 1:
+            cssPath = next(iter(self.entries))
+            self.evicted_bytes += self.drop(cssPath)
+
+    def get_stats(self) -> dict:
+        return {
+            "files": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evicted_bytes": self.evicted_bytes,
+        }
+
+CSS_FILE_CACHE = CssFileCache(CSS_CACHE_BUDGET)
+
+def register_injects(injects : List["Inject"]):
+    # Injects created after _cache_lists (lazily built patch options) still need a priority and a place in the tab index
+    for x in injects:
+        x.priority = (x.theme.load_order, len(ALL_INJECTS))
+        ALL_INJECTS.append(x)
+
+    add_tab_patterns(injects)
 
 def helper_get_tab_from_list(tab_list : List[str], cssTab : CssTab) -> str|None:
     for x in tab_list:
@@ -20,16 +102,14 @@ class Inject:
         self.uuids = {}
         self.theme = theme
         self.enabled = False
+        self.priority = (0, 0)
         for x in self.tabs:
             self.uuids[x] = []
 
     async def load(self) -> Result:
         try:
-            with open(self.cssPath, "r") as fp:
-                self.css = fp.read()
-
+            self.css = CSS_FILE_CACHE.read(self.cssPath)
             Log(f"Loaded css at {self.cssPath}")
-            self.css = self.css.replace("\\", "\\\\").replace("`", "\\`")
 
             return Result(True)
         except Exception as e:
@@ -39,7 +119,9 @@ class Inject:
         for tab_name in self.tabs:
             for uuid in self.uuids[tab_name]:
                 Log(f"-{uuid} @ {tab_name}")
-                res = await remove(tab_name, uuid)
+                res = await remove(tab_name, uuid, self)
+
+            self.uuids[tab_name] = []
 
             if (self.css is None):
                 result = await self.load()
@@ -47,7 +129,7 @@ class Inject:
                     return result        
 
             try:
-                res = await inject(tab_name, self.css)
+                res = await inject(tab_name, self.css, self.priority, self)
                 if not res.success:
                     return res
 
@@ -71,17 +153,27 @@ class Inject:
                 return result
 
         try:
-            res = await tab.inject_css(self.css)
+            res = await tab.inject_css(self.css, priority=self.priority, owner=self)
             if not res.success:
                 return res
 
             Log(f"+{str(res.message)} @ {tab_name}")
-            self.uuids[tab_name].append(str(res.message))
+            if str(res.message) not in self.uuids[tab_name]:
+                self.uuids[tab_name].append(str(res.message))
         except Exception as e:
             return Result(False, str(e))    
         
         return Result(True)
 
+    async def remove_from_tab(self, tab : CssTab) -> Result:
+        for tab_name in self.tabs:
+            for x in self.uuids[tab_name]:
+                if x in tab.style_owners and self in tab.style_owners[x]:
+                    Log(f"-{x} @ {tab.title}")
+                    await tab.remove_css(x, self)
+
+        return Result(True)
+
     async def remove(self) -> Result:
         for tab_name in self.tabs:
             if (len(self.uuids[tab_name]) <= 0):
@@ -90,7 +182,7 @@ class Inject:
             try:
                 for x in self.uuids[tab_name]:
                     Log(f"-{x} @ {tab_name}")
-                    res = await remove(tab_name, x)
+                    res = await remove(tab_name, x, self)
                     #if not res["success"]:
                     #    return Result(False, res["result"])
                     # Silently ignore error. If any page gets reloaded, and there was css loaded. this will fail as it will fail to remove the css
@@ -150,5 +242,17 @@ def to_inject(key : str, tabs : list, basePath : str, theme) -> Inject:
     
     return inject
 
+def validate_injects(items : dict):
+    '''Raises on data to_injects can't build injects from, without building them'''
+    if not isinstance(items, dict):
+        raise Exception(f"Expected an object of injects, got {type(items).__name__}")
+
+    for x in items:
+        if not isinstance(items[x], list):
+            raise Exception(f"Tabs of '{x}' are not a list")
+
+        if x.startswith("--") and len(items[x]) <= 0:
+            raise Exception(f"Css variable '{x}' has no value")
+
 def to_injects(items : dict, basePath : str, theme) -> list:
     return [to_inject(x, items[x], basePath, theme) for x in items]
\ No newline at end of file
@@ -1,6 +1,7 @@
-import asyncio, json, tempfile, os, aiohttp, zipfile
+import asyncio, json, tempfile, os, aiohttp, zipfile, shutil, time
 from css_utils import Result, Log, get_theme_path, store_or_file_config
 from css_theme import CSS_LOADER_VER
+from css_blobcache import BlobCache, BLOB_CACHE
 
 async def run(command : str) -> str:
     proc = await asyncio.create_subprocess_shell(command,        
@@ -13,55 +14,209 @@ async def run(command : str) -> str:
 
     return stdout.decode()
 
-async def install(id : str, base_url : str, local_themes : list) -> Result:
-    if not base_url.endswith("/"):
-        base_url = base_url + "/"
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+PROGRESS_INTERVAL = 1
+INSTALL_CONCURRENCY = 4
 
-    url = f"{base_url}themes/{id}"
+def create_session() -> aiohttp.ClientSession:
+    return aiohttp.ClientSession(headers={"User-Agent": f"SDH-CSSLoader/{CSS_LOADER_VER}"}, connector=aiohttp.TCPConnector(verify_ssl=False, limit=INSTALL_CONCURRENCY))
 
-    async with aiohttp.ClientSession(headers={"User-Agent": f"SDH-CSSLoader/{CSS_LOADER_VER}"}, connector=aiohttp.TCPConnector(verify_ssl=False)) as session:
-        try:
-            async with session.get(url) as resp:
-                if resp.status != 200:
-                    raise Exception(f"Invalid status code {resp.status}")
+async def download(session : aiohttp.ClientSession, url : str, outPath : str, progress = None) -> int:
+    '''Streams url into outPath chunk by chunk. progress(done, total) is called at most once per PROGRESS_INTERVAL'''
+    start = time.monotonic()
+    lastReport = start
+    done = 0
+
+    async with session.get(url) as resp:
+        if resp.status != 200:
+            raise Exception(f"Got {resp.status} code from '{url}'")
+
+        total = resp.content_length
+
+        with open(outPath, "wb") as out:
+            async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                out.write(chunk)
+                done += len(chunk)
+
+                now = time.monotonic()
+                if now - lastReport >= PROGRESS_INTERVAL:
+                    lastReport = now
+                    Log(f"Downloaded {done}{'' if total is None else f'/{total}'} bytes ({done / (now - start) / 1024:.0f} KiB/s)")
+                    if progress is not None:
+                        progress(done, total)
+
+    elapsed = max(time.monotonic() - start, 0.001)
+    Log(f"Downloaded {done} bytes in {elapsed:.2f}s ({done / elapsed / 1024:.0f} KiB/s)")
+
+    if progress is not None:
+        progress(done, total)
+
+    return done
+
+def is_user_file(name : str) -> bool:
+    '''Files the user or the loader put into an installed theme folder, kept when the theme is reinstalled'''
+    return name == "PRIORITY" or (name.startswith("config_") and name.endswith(".json"))
+
+def extract_and_swap(zipPath : str, themesPath : str) -> list:
+    '''Extracts into a staging folder next to the themes, then moves every top level folder into place.
+    Runs off the event loop'''
+    stagingPath = tempfile.mkdtemp(prefix=".install-", dir=themesPath)
+    installed = []
+
+    try:
+        with zipfile.ZipFile(zipPath, 'r') as zip:
+            zip.extractall(stagingPath)
+
+        for x in os.listdir(stagingPath):
+            src = os.path.join(stagingPath, x)
+            dst = os.path.join(themesPath, x)
+
+            if not os.path.isdir(src):
+                os.replace(src, dst)
+                continue
+
+            oldPath = None
+            if os.path.isdir(dst):
+                for y in os.listdir(dst):
+                    if is_user_file(y) and not os.path.exists(os.path.join(src, y)):
+                        shutil.copy2(os.path.join(dst, y), os.path.join(src, y))
+
+            if os.path.exists(dst):
+                oldPath = os.path.join(stagingPath, f".old-{x}")
+                os.replace(dst, oldPath)
+
+            try:
+                os.replace(src, dst)
+            except Exception:
+                if oldPath is not None: # Put the existing install back before the staging folder gets removed
+                    os.replace(oldPath, dst)
+
+                raise
+
+            installed.append(x)
 
-                data = await resp.json()
-        except Exception as e:
-            return Result(False, str(e))
+            if oldPath is not None:
+                shutil.rmtree(oldPath, ignore_errors=True)
+    finally:
+        shutil.rmtree(stagingPath, ignore_errors=True)
 
-        if (data["manifestVersion"] > CSS_LOADER_VER):
-            raise Exception("Manifest version of themedb entry is unsupported by this version of CSS_Loader")
+    return installed
 
-        download_url = f"{base_url}blobs/{data['download']['id']}" 
-        tempDir = tempfile.TemporaryDirectory()
+async def fetch_theme_data(session : aiohttp.ClientSession, base_url : str, id : str, cache : BlobCache = None) -> dict:
+    cached = cache.get_meta(f"{base_url}themes/{id}") if cache is not None else None
+    headers = {"If-None-Match": cached["etag"]} if cached is not None else {}
+
+    async with session.get(f"{base_url}themes/{id}", headers=headers) as resp:
+        if resp.status == 304 and cached is not None:
+            data = cached["data"]
+        elif resp.status != 200:
+            raise Exception(f"Invalid status code {resp.status}")
+        else:
+            data = await resp.json()
+
+            if cache is not None:
+                cache.put_meta(f"{base_url}themes/{id}", resp.headers.get("ETag"), data)
+
+    if (data["manifestVersion"] > CSS_LOADER_VER):
+        raise Exception("Manifest version of themedb entry is unsupported by this version of CSS_Loader")
+
+    return data
+
+async def resolve_install_plan(session : aiohttp.ClientSession, base_url : str, id : str, local_themes : list, cache : BlobCache = None) -> list:
+    '''Fetches the metadata of a theme and its full dependency closure, one level at a time. Every theme id appears once'''
+    plan = [await fetch_theme_data(session, base_url, id, cache)]
+    seen_ids = set([id])
+    seen_names = set(local_themes)
+    level = plan
+
+    while len(level) > 0 and not store_or_file_config("no_deps_install"):
+        ids = []
+        for data in level:
+            for x in data["dependencies"]:
+                if x["id"] in seen_ids or x["name"] in seen_names:
+                    continue
+
+                seen_ids.add(x["id"])
+                seen_names.add(x["name"])
+                ids.append(x["id"])
+
+        results = await asyncio.gather(*[fetch_theme_data(session, base_url, x, cache) for x in ids], return_exceptions=True)
+        level = []
+
+        for (x, data) in zip(ids, results):
+            if isinstance(data, Exception):
+                Log(f"Failed to resolve dependency {x}: {str(data)}")
+            else:
+                level.append(data)
+
+        plan.extend(level)
+
+    return plan
+
+async def install_theme_data(session : aiohttp.ClientSession, base_url : str, data : dict, progress = None, cache : BlobCache = None):
+    blob_id = data['download']['id']
+    download_url = f"{base_url}blobs/{blob_id}" 
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        themeZipPath = cache.get_blob(blob_id) if cache is not None else None
+
+        if themeZipPath is not None:
+            Log(f"Using cached blob {themeZipPath}")
+        elif cache is not None:
+            Log(f"Downloading {download_url} into the blob cache...")
+            downloadPath = cache.get_download_path(blob_id)
+
+            try:
+                await download(session, download_url, downloadPath, progress)
+                themeZipPath = cache.add_blob(blob_id, downloadPath)
+            finally:
+                if os.path.exists(downloadPath):
+                    os.remove(downloadPath)
+        else:
+            Log(f"Downloading {download_url} to {tempDir}...")
+            themeZipPath = os.path.join(tempDir, 'theme.zip')
+            await download(session, download_url, themeZipPath, progress)
 
-        Log(f"Downloading {download_url} to {tempDir.name}...")
-        themeZipPath = os.path.join(tempDir.name, 'theme.zip')
         try:
-            async with session.get(download_url) as resp:
-                if resp.status != 200:
-                    raise Exception(f"Got {resp.status} code from '{download_url}'")
+            Log(f"Unzipping {themeZipPath}")
+            installed = await asyncio.get_running_loop().run_in_executor(None, extract_and_swap, themeZipPath, get_theme_path())
+            Log(f"Installed {installed}")
+        except Exception:
+            if cache is not None: # Don't keep reusing a blob that can't be extracted
+                cache.discard(blob_id)
 
-                with open(themeZipPath, "wb") as out:
-                    out.write(await resp.read())
+            raise
+        finally:
+            if cache is not None:
+                cache.release(blob_id)
 
-        except Exception as e:
-            return Result(False, str(e))
+async def install(id : str, base_url : str, local_themes : list, session : aiohttp.ClientSession = None, progress = None, cache : BlobCache = BLOB_CACHE) -> Result:
+    if session is None:
+        async with create_session() as session:
+            return await install(id, base_url, local_themes, session, progress, cache)
+
+    if not base_url.endswith("/"):
+        base_url = base_url + "/"
 
-    Log(f"Unzipping {themeZipPath}")
     try:
-        with zipfile.ZipFile(themeZipPath, 'r') as zip:
-            zip.extractall(get_theme_path())
+        plan = await resolve_install_plan(session, base_url, id, local_themes, cache)
     except Exception as e:
         return Result(False, str(e))
 
-    tempDir.cleanup()
+    Log(f"Installing {[x['name'] for x in plan]}")
+    semaphore = asyncio.Semaphore(INSTALL_CONCURRENCY)
 
-    if not store_or_file_config("no_deps_install"):
-        for x in data["dependencies"]:
-            if x["name"] in local_themes:
-                continue
-            
-            await install(x["id"], base_url, local_themes)
+    async def install_one(data : dict):
+        async with semaphore:
+            await install_theme_data(session, base_url, data, progress, cache)
+
+    results = await asyncio.gather(*[install_one(x) for x in plan], return_exceptions=True)
+
+    for (data, result) in zip(plan[1:], results[1:]):
+        if isinstance(result, Exception):
+            Log(f"Failed to install dependency {data['name']}: {str(result)}")
+
+    if isinstance(results[0], Exception):
+        return Result(False, str(results[0]))
     
     return Result(True)
\ No newline at end of file
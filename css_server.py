@@ -1,10 +1,11 @@
 import asyncio, aiohttp.web, json
-from css_utils import Log, create_cef_flag
+from css_utils import Log, create_cef_flag, add_event_listener, remove_event_listener
+from css_browserhook import batch_commits
 
 PLUGIN_CLASS = None
+MAX_EVENT_BACKLOG = 256
 
-async def handle(request : aiohttp.web.BaseRequest):
-    data = await request.json()
+async def call_method(data : dict) -> dict:
     request_result = {"res": None, "success": True}
 
     # This is very cool decky code
@@ -13,8 +14,69 @@ async def handle(request : aiohttp.web.BaseRequest):
     except Exception as e:
         request_result["res"] = str(e)
         request_result["success"] = False
+    
+    return request_result
+
+async def handle(request : aiohttp.web.BaseRequest):
+    data = await request.json()
+    request_result = await call_method(data)
+    return aiohttp.web.Response(text=json.dumps(request_result, ensure_ascii=False), content_type='application/json')
+
+async def handle_batch(request : aiohttp.web.BaseRequest):
+    request_result = {"res": [], "success": True}
+
+    try:
+        data = await request.json()
+        calls = data["calls"] if isinstance(data, dict) else data
+
+        # Calls run in order, tabs only get one css commit once all of them are done
+        async with batch_commits():
+            for x in calls:
+                request_result["res"].append(await call_method(x))
+    except Exception as e:
+        request_result["res"] = str(e)
+        request_result["success"] = False
+
+    return aiohttp.web.Response(text=json.dumps(request_result, ensure_ascii=False), content_type='application/json')
+
+async def handle_events(request : aiohttp.web.BaseRequest):
+    '''Sends the full theme list once, then every theme state change as {"event", "data"}'''
+    ws = aiohttp.web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+    queue = asyncio.Queue(maxsize=MAX_EVENT_BACKLOG)
+
+    def on_event(event : str, data : dict):
+        if queue.full(): # Client can't keep up, let it fetch the full list again
+            while not queue.empty():
+                queue.get_nowait()
+
+            event, data = "themes_reloaded", {}
+
+        queue.put_nowait({"event": event, "data": data})
+
+    add_event_listener(on_event)
+    receive_task = asyncio.create_task(ws.receive())
+
+    try:
+        await ws.send_str(json.dumps({"event": "themes", "data": await PLUGIN_CLASS.get_themes(PLUGIN_CLASS)}, ensure_ascii=False))
+
+        while not ws.closed:
+            get_task = asyncio.create_task(queue.get())
+            await asyncio.wait([get_task, receive_task], return_when=asyncio.FIRST_COMPLETED)
+
+            if not get_task.done(): # The client closed the socket or sent something, we don't take messages
+                get_task.cancel()
+                break
+
+            await ws.send_str(json.dumps(get_task.result(), ensure_ascii=False))
+    except Exception as e:
+        Log(f"Event socket closed: {str(e)}")
     finally:
-        return aiohttp.web.Response(text=json.dumps(request_result, ensure_ascii=False), content_type='application/json')
+        remove_event_listener(on_event)
+        receive_task.cancel()
+        await ws.close()
+
+    return ws
 
 def start_server(plugin):
     global PLUGIN_CLASS
@@ -24,5 +86,7 @@ def start_server(plugin):
     create_cef_flag()
     app = aiohttp.web.Application(loop=loop)
     app.router.add_route('POST', '/req', handle)
+    app.router.add_route('POST', '/batch', handle_batch)
+    app.router.add_route('GET', '/events', handle_events)
     loop.create_task(aiohttp.web._run_app(app, host="127.0.0.1", port=35821))
     Log("Started CSS_Loader server on port 35821")
\ No newline at end of file
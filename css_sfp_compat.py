@@ -15,11 +15,18 @@ def is_folder_sfp_theme(dir : str) -> bool:
         
     return False
 
-def convert_to_css_theme(dir : str, theme) -> None:
+def get_sfp_files(dir : str) -> list:
+    return [x for x in SFP_DEFAULT_FILES if os.path.exists(os.path.join(dir, x))]
+
+def convert_to_css_theme(dir : str, theme, files : list = None) -> None:
+    if files is None:
+        files = get_sfp_files(dir)
+
     theme.name = os.path.basename(dir)
     theme.id = theme.name
     theme.version = "v1.0"
     theme.author = ""
     theme.require = 1
     theme.dependencies = []
-    theme.injects = [to_inject(x, SFP_DEFAULT_FILES[x], dir, theme) for x in SFP_DEFAULT_FILES if os.path.exists(os.path.join(dir, x))]
\ No newline at end of file
+    theme.sfp_files = files
+    theme.injects = [to_inject(x, SFP_DEFAULT_FILES[x], dir, theme) for x in files]
\ No newline at end of file
@@ -1,15 +1,16 @@
-import os, json, shutil, time
+import os, json, shutil
 from os import path
 from typing import List
 from css_inject import Inject, to_injects
-from css_utils import Result, Log, create_dir, USER
+from css_utils import Result, Log, USER, emit_event
+from css_themestate import THEME_STATE
 from css_themepatch import ThemePatch
 from css_sfp_compat import is_folder_sfp_theme, convert_to_css_theme
 
 CSS_LOADER_VER = 8
 
 class Theme:
-    def __init__(self, themePath : str, json : dict, configPath : str = None):
+    def __init__(self, themePath : str, json : dict, configPath : str = None, indexEntry : dict = None):
         self.configPath = configPath if (configPath is not None) else themePath
         self.configJsonPath = self.configPath + "/config" + ("_ROOT.json" if USER == "root" else "_USER.json")
         self.patches = []
@@ -21,37 +22,55 @@ class Theme:
         self.enabled = False
         self.json = json
         self.priority_mod = 0
+        self.load_order = 0
         self.created = None
-        self.modified = path.getmtime(self.configJsonPath) if path.exists(self.configJsonPath) else None
-
-        try:
-            if (os.path.join(themePath, "PRIORITY")):
-                with open(os.path.join(themePath, "PRIORITY")) as fp:
-                    self.priority_mod = int(fp.readline().strip())
-        except:
-            pass
+        self.layout = "json"
+        self.sfp_files = []
+        self.modified = None
+        self.saved_config = {}
+
+        if indexEntry is not None:
+            self.priority_mod = indexEntry["priority"]
+        else:
+            try:
+                if (os.path.join(themePath, "PRIORITY")):
+                    with open(os.path.join(themePath, "PRIORITY")) as fp:
+                        self.priority_mod = int(fp.readline().strip())
+            except:
+                pass
         
         if (json is None):
-            if os.path.exists(os.path.join(themePath, "theme.css")):
+            layout = indexEntry["layout"] if indexEntry is not None else None
+
+            if layout == "legacy" or (layout is None and os.path.exists(os.path.join(themePath, "theme.css"))):
                 self.name = os.path.basename(themePath)
                 self.id = self.name
                 self.version = "v1.0"
                 self.author = ""
                 self.require = 1
+                self.layout = "legacy"
                 self.injects = [Inject(os.path.join(themePath, "theme.css"), [".*"], self)]
                 self.dependencies = []
                 return
-            elif is_folder_sfp_theme(themePath):
+            elif layout == "sfp":
+                self.layout = "sfp"
+                convert_to_css_theme(themePath, self, indexEntry["sfp_files"])
+                return
+            elif layout is None and is_folder_sfp_theme(themePath):
+                self.layout = "sfp"
                 convert_to_css_theme(themePath, self)
                 return
             else:
                 raise Exception("Folder does not look like a theme?")
             
             
-        jsonPath = path.join(self.themePath, "theme.json")
-        
-        if path.exists(jsonPath):
-            self.created = path.getmtime(jsonPath)
+        if indexEntry is not None:
+            self.created = indexEntry["created"]
+        else:
+            jsonPath = path.join(self.themePath, "theme.json")
+            
+            if path.exists(jsonPath):
+                self.created = path.getmtime(jsonPath)
 
         self.name = json["name"]
         self.id = json["id"] if ("id" in json) else self.name
@@ -72,16 +91,27 @@ class Theme:
         if "patches" in self.json:
             self.patches = [ThemePatch(self, self.json["patches"][x], x) for x in self.json["patches"]]
     
-    async def load(self, inject_now : bool = True) -> Result:
-        if not path.exists(self.configJsonPath):
-            return Result(True)
+    def to_index_entry(self) -> dict:
+        return {
+            "manifest": self.json,
+            "layout": self.layout,
+            "sfp_files": self.sfp_files,
+            "priority": self.priority_mod,
+            "created": self.created,
+        }
 
+    async def load(self, inject_now : bool = True) -> Result:
         try:
-            with open(self.configJsonPath, "r") as fp:
-                config = json.load(fp)
+            entry = THEME_STATE.get(self.configJsonPath)
         except Exception as e:
             return Result(False, str(e))
+
+        if entry is None:
+            self.saved_config = self.get_config()
+            return Result(True)
         
+        config = entry["config"]
+        self.modified = entry["modified"]
         activate = False
 
         for x in config:
@@ -92,6 +122,10 @@ class Theme:
                     if y.name == x:
                         y.set_value(config[x])
         
+        # What's saved now, with every patch present, so the next save can report exactly what changed
+        self.saved_config = self.get_config()
+        self.saved_config["active"] = activate
+
         if activate:
             result = await self.inject(inject_now)
             if not result.success:
@@ -99,21 +133,30 @@ class Theme:
         
         return Result(True)
 
-    async def save(self) -> Result:
-        create_dir(self.configPath)
+    def get_config(self) -> dict:
+        config = {"active": self.enabled}
+        for x in self.patches:
+            config[x.name] = x.get_value()
+
+        return config
 
+    async def save(self) -> Result:
         try:
-            config = {"active": self.enabled}
-            for x in self.patches:
-                config[x.name] = x.get_value()
-            
-            with open(self.configJsonPath, "w") as fp:
-                json.dump(config, fp)
-        
-            self.modified = time.time()
+            config = self.get_config()
+            self.modified = THEME_STATE.set(self.configJsonPath, config)
         except Exception as e:
             return Result(False, str(e))
         
+        previous = self.saved_config
+        self.saved_config = config
+
+        if previous.get("active", False) != self.enabled:
+            emit_event("theme_enabled" if self.enabled else "theme_disabled", {"name": self.name})
+
+        for x in self.patches:
+            if previous.get(x.name) != config[x.name]:
+                emit_event("patch_changed", {"theme": self.name, "patch": x.name, "value": config[x.name]})
+
         return Result(True)
 
     async def inject(self, inject_now : bool = True) -> Result:
@@ -157,6 +200,7 @@ class Theme:
         except Exception as e:
             return Result(False, str(e))
         
+        THEME_STATE.remove(self.configJsonPath)
         return Result(True)
 
     def get_all_injects(self) -> List[Inject]:
@@ -0,0 +1,89 @@
+import os, json, threading
+from css_utils import Log, Result
+
+INDEX_VERSION = 1
+
+def stat_key(path : str) -> list|None:
+    try:
+        stat = os.stat(path)
+        return [stat.st_mtime_ns, stat.st_size]
+    except OSError:
+        return None
+
+class ThemeIndex:
+    '''On-disk cache of parsed theme manifests, keyed by theme folder and validated by mtime/size'''
+    def __init__(self, indexPath : str):
+        self.indexPath = indexPath
+        self.entries = {}
+        self.seen = set()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock() # Themes are parsed from a worker pool
+
+    def load(self) -> Result:
+        self.entries = {}
+
+        if not os.path.exists(self.indexPath):
+            return Result(True)
+
+        try:
+            with open(self.indexPath, "r") as fp:
+                data = json.load(fp)
+
+            if data.get("version") == INDEX_VERSION:
+                self.entries = data["entries"]
+        except Exception as e:
+            return Result(False, f"Failed to read theme index: {str(e)}")
+
+        return Result(True)
+
+    def save(self) -> Result:
+        # Entries of folders that weren't seen this scan belong to deleted themes
+        for x in [x for x in self.entries if x not in self.seen]:
+            del self.entries[x]
+            self.dirty = True
+
+        if not self.dirty:
+            return Result(True)
+
+        try:
+            tempPath = self.indexPath + ".tmp"
+            with open(tempPath, "w") as fp:
+                json.dump({"version": INDEX_VERSION, "entries": self.entries}, fp)
+
+            os.replace(tempPath, self.indexPath)
+            self.dirty = False
+        except Exception as e:
+            return Result(False, f"Failed to write theme index: {str(e)}")
+
+        return Result(True)
+
+    def get_stats(self, themePath : str) -> dict:
+        return {
+            "folder": stat_key(themePath),
+            "json": stat_key(os.path.join(themePath, "theme.json")),
+            "priority": stat_key(os.path.join(themePath, "PRIORITY")),
+        }
+
+    def get(self, themePath : str, stats : dict) -> dict|None:
+        with self.lock:
+            self.seen.add(themePath)
+            entry = self.entries.get(themePath)
+
+            if entry is None or entry["stats"] != stats:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return entry
+
+    def put(self, themePath : str, stats : dict, entry : dict):
+        with self.lock:
+            self.seen.add(themePath)
+            entry["stats"] = stats
+            self.entries[themePath] = entry
+            self.dirty = True
+
+    def report(self):
+        Log(f"Theme index: {self.hits} hit(s), {self.misses} miss(es)")
@@ -1,4 +1,4 @@
-from css_inject import Inject, to_injects
+from css_inject import Inject, to_injects, register_injects, validate_injects
 from css_themepatchcomponent import ThemePatchComponent
 from css_utils import Log, Result
 
@@ -14,6 +14,7 @@ class ThemePatch:
         self.options = {}
         self.patchVersion = None
         self.components = []
+        self.loaded_options = set()
 
         if "values" in json: # Do we have a v2 or a v1 format?
             self.patchVersion = 2
@@ -80,14 +81,18 @@ class ThemePatch:
             if not ("No" in self.options and "Yes" in self.options):
                 self.type = "dropdown"
     
+    def get_option_data(self, option : str) -> dict:
+        return self.json[option] if self.patchVersion == 1 else self.json["values"][option]
+
     def load(self):
+        # Option injects are only built once an option gets selected, see get_option_injects.
+        # Their data is still checked here so a broken option rejects the theme while parsing
         for x in self.options:
-            data = self.json[x] if self.patchVersion == 1 else self.json["values"][x]
+            try:
+                validate_injects(self.get_option_data(x))
+            except Exception as e:
+                raise Exception(f"In patch '{self.name}', option '{x}': {str(e)}")
 
-            items = to_injects(data, self.theme.themePath, self.theme)
-            self.injects.extend(items)
-            self.options[x].extend(items)
-        
         if "components" in self.json:
             for x in self.json["components"]:
                 component = ThemePatchComponent(self, x)
@@ -100,10 +105,26 @@ class ThemePatch:
 
         self.check_value()
 
+    def get_option_injects(self, option : str) -> list:
+        if option not in self.loaded_options:
+            self.loaded_options.add(option)
+            items = to_injects(self.get_option_data(option), self.theme.themePath, self.theme)
+            self.injects.extend(items)
+            self.options[option] = items + self.options[option]
+            register_injects(items)
+
+        return self.options[option]
+
     async def inject(self, inject_now : bool = True) -> Result:
         self.check_value()
         Log(f"Injecting patch '{self.name}' of theme '{self.theme.name}'")
-        for x in self.options[self.value]:
+
+        try:
+            injects = self.get_option_injects(self.value)
+        except Exception as e:
+            return Result(False, f"Failed to load option '{self.value}' of patch '{self.name}': {str(e)}")
+
+        for x in injects:
             if inject_now:
                 await x.inject() # Ignore result for now. It'll be logged but not acted upon
             else:
@@ -0,0 +1,61 @@
+
+class ThemeRegistry:
+    '''Indexes loaded themes by name, id and (theme, patch, component)'''
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.by_name = {}
+        self.by_id = {}
+        self.patches = {}
+        self.components = {}
+
+    def add(self, theme) -> bool:
+        if theme.name in self.by_name:
+            return False
+
+        self.by_name[theme.name] = theme
+
+        if theme.id not in self.by_id:
+            self.by_id[theme.id] = theme
+
+        for x in theme.patches:
+            self.patches[(theme.name, x.name)] = x
+
+            for y in x.components:
+                self.components[(theme.name, x.name, y.name)] = y
+
+        return True
+
+    def remove(self, theme):
+        if self.by_name.get(theme.name) is not theme:
+            return
+
+        del self.by_name[theme.name]
+
+        if self.by_id.get(theme.id) is theme:
+            del self.by_id[theme.id]
+
+        for x in theme.patches:
+            self.patches.pop((theme.name, x.name), None)
+
+            for y in x.components:
+                self.components.pop((theme.name, x.name, y.name), None)
+
+    def get(self, name : str):
+        return self.by_name.get(name)
+
+    def get_by_id(self, id : str):
+        return self.by_id.get(id)
+
+    def get_patch(self, themeName : str, patchName : str):
+        return self.patches.get((themeName, patchName))
+
+    def get_component(self, themeName : str, patchName : str, componentName : str):
+        return self.components.get((themeName, patchName, componentName))
+
+    def __contains__(self, name : str) -> bool:
+        return name in self.by_name
+
+    def __len__(self) -> int:
+        return len(self.by_name)
@@ -0,0 +1,102 @@
+import os, json, sqlite3, time, asyncio
+from css_utils import Log, theme_state_path
+
+STATE_FLUSH_DELAY = 0.5
+
+class ThemeStateStore:
+    '''Active flags, patch and component values of every theme in one sqlite database.
+    Writes are coalesced and committed in a single transaction'''
+    def __init__(self):
+        self.path = None
+        self.entries = {}
+        self.dirty = {}
+        self.flush_handle = None
+        self.loaded = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE IF NOT EXISTS theme_state (key TEXT PRIMARY KEY, config TEXT NOT NULL, modified REAL)")
+        return conn
+
+    def load(self, path : str = None):
+        self.flush()
+        self.path = path if path is not None else theme_state_path()
+        self.entries = {}
+
+        try:
+            conn = self._connect()
+            try:
+                for (key, config, modified) in conn.execute("SELECT key, config, modified FROM theme_state"):
+                    self.entries[key] = {"config": json.loads(config), "modified": modified}
+            finally:
+                conn.close()
+        except Exception as e:
+            Log(f"[Warn] Failed to read theme state from {self.path}: {str(e)}")
+
+        self.loaded = True
+        Log(f"Loaded state of {len(self.entries)} themes")
+
+    def get(self, key : str) -> dict | None:
+        '''Returns {"config", "modified"} for a theme config path, importing an old per-theme config file once'''
+        if not self.loaded:
+            self.load()
+
+        if key in self.entries:
+            return self.entries[key]
+
+        if not os.path.exists(key):
+            return None
+
+        with open(key, "r") as fp:
+            config = json.load(fp)
+
+        Log(f"Imported theme state from {key}")
+        self.entries[key] = {"config": config, "modified": os.path.getmtime(key)}
+        self._mark_dirty(key)
+        return self.entries[key]
+
+    def set(self, key : str, config : dict) -> float:
+        modified = time.time()
+        self.entries[key] = {"config": config, "modified": modified}
+        self._mark_dirty(key)
+        return modified
+
+    def remove(self, key : str):
+        if key in self.entries:
+            del self.entries[key]
+            self._mark_dirty(key)
+
+    def _mark_dirty(self, key : str):
+        self.dirty[key] = self.entries.get(key)
+
+        if self.flush_handle is not None:
+            return
+
+        try:
+            self.flush_handle = asyncio.get_running_loop().call_later(STATE_FLUSH_DELAY, self.flush)
+        except RuntimeError:
+            self.flush()
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        if len(self.dirty) <= 0 or self.path is None:
+            return
+
+        dirty = self.dirty
+        self.dirty = {}
+
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO theme_state (key, config, modified) VALUES (?, ?, ?)", [(x, json.dumps(dirty[x]["config"]), dirty[x]["modified"]) for x in dirty if dirty[x] is not None])
+                    conn.executemany("DELETE FROM theme_state WHERE key = ?", [(x,) for x in dirty if dirty[x] is None])
+            finally:
+                conn.close()
+        except Exception as e:
+            Log(f"[Warn] Failed to write theme state to {self.path}: {str(e)}")
+
+THEME_STATE = ThemeStateStore()
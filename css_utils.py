@@ -1,5 +1,5 @@
 from logging import getLogger
-import os, platform
+import os, platform, time, asyncio
 
 HOME = os.getenv("HOME")
 
@@ -30,6 +30,23 @@ FLAG_PRESET = "PRESET"
 def Log(text : str):
     Logger.info(f"[CSS_Loader] {text}")
 
+EVENT_LISTENERS = []
+
+def add_event_listener(listener):
+    '''listener(event, data) is called for every emitted event, it should not block'''
+    EVENT_LISTENERS.append(listener)
+
+def remove_event_listener(listener):
+    if listener in EVENT_LISTENERS:
+        EVENT_LISTENERS.remove(listener)
+
+def emit_event(event : str, data : dict):
+    for x in list(EVENT_LISTENERS):
+        try:
+            x(event, data)
+        except Exception as e:
+            Log(f"Event listener failed on {event}: {str(e)}")
+
 class Result:
     def __init__(self, success : bool, message : str = "Success", log : bool = True):
         self.success = success
@@ -105,45 +122,155 @@ def create_cef_flag() -> Result:
         with open(path, 'w') as fp:
             pass
 
+def get_cache_path() -> str:
+    return os.path.join(os.getenv("DECKY_PLUGIN_RUNTIME_DIR", os.path.join(DECKY_HOME, "data", "SDH-CssLoader")), "blobs")
+
+def theme_index_path() -> str:
+    return os.path.join(get_theme_path(), ".theme_index.json")
+
+def theme_state_path() -> str:
+    return os.path.join(get_theme_path(), ".theme_state.db")
+
 def store_path() -> str:
     return os.path.join(get_theme_path(), "STORE")
 
-def store_reads() -> dict:
-    path = store_path()
-    items = {}
+STORE_CHECK_INTERVAL = 1
+STORE_WRITE_DELAY = 0.5
+
+class StoreCache:
+    '''In-memory copy of the STORE file and of the flag files in the themes folder.
+    External changes are picked up by mtime, writes are batched and saved with an atomic rename'''
+    def __init__(self):
+        self.items = None
+        self.mtime = None
+        self.flags = {}
+        self.flags_mtime = None
+        self.checked = 0
+        self.dirty = False
+        self.write_handle = None
+
+    def _stat_mtime(self, path : str) -> int | None:
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
 
-    if not os.path.exists(path):
+    def _refresh(self):
+        now = time.monotonic()
+        if self.items is not None and now - self.checked < STORE_CHECK_INTERVAL:
+            return
+
+        self.checked = now
+        themesPath = get_theme_path()
+
+        flags_mtime = self._stat_mtime(themesPath)
+        if flags_mtime != self.flags_mtime:
+            self.flags = {}
+            self.flags_mtime = flags_mtime
+
+        if self.dirty: # Pending writes win over the file on disk
+            return
+
+        path = store_path()
+        mtime = self._stat_mtime(path)
+        if self.items is None or mtime != self.mtime:
+            self.items = self._parse(path) if mtime is not None else {}
+            self.mtime = mtime
+
+    def _parse(self, path : str) -> dict:
+        items = {}
+
+        with open(path, 'r') as fp:
+            for x in fp.readlines():
+                c = x.strip()
+                if (c == ""):
+                    continue
+
+                split = c.split(":", 1)
+
+                if (len(split) <= 1):
+                    continue
+
+                items[split[0]] = split[1]
+        
         return items
 
-    with open(path, 'r') as fp:
-        for x in fp.readlines():
-            c = x.strip()
-            if (c == ""):
-                continue
+    def get_all(self) -> dict:
+        self._refresh()
+        return dict(self.items)
 
-            split = c.split(":", 1)
+    def get_many(self, keys : list) -> dict:
+        self._refresh()
+        return {x: self.items.get(x, "") for x in keys}
 
-            if (len(split) <= 1):
-                continue
+    def set_many(self, items : dict):
+        self._refresh()
 
-            items[split[0]] = split[1]
-    
-    return items
+        for x in items:
+            self.items[x] = items[x].replace('\n', '')
+
+        self.dirty = True
+
+        if self.write_handle is not None:
+            return
+
+        try:
+            self.write_handle = asyncio.get_running_loop().call_later(STORE_WRITE_DELAY, self.flush)
+        except RuntimeError:
+            self.flush()
+
+    def has_flag_file(self, key : str) -> bool:
+        self._refresh()
+
+        if key not in self.flags:
+            self.flags[key] = os.path.exists(os.path.join(get_theme_path(), key.upper()))
+
+        return self.flags[key]
+
+    def flush(self):
+        if self.write_handle is not None:
+            self.write_handle.cancel()
+            self.write_handle = None
+
+        if not self.dirty:
+            return
+
+        path = store_path()
+        tmpPath = path + ".tmp"
+
+        try:
+            with open(tmpPath, 'w') as fp:
+                fp.write("\n".join([f"{x}:{self.items[x]}" for x in self.items]))
+
+            os.replace(tmpPath, path)
+            self.mtime = self._stat_mtime(path)
+            self.dirty = False
+        except Exception as e:
+            Log(f"[Warn] Failed to write {path}: {str(e)}")
+
+STORE_CACHE = StoreCache()
+
+def store_reads() -> dict:
+    return STORE_CACHE.get_all()
 
 def store_read(key : str) -> str:
-    items = store_reads()
-    return items[key] if key in items else ""
+    return STORE_CACHE.get_many([key])[key]
+
+def store_read_many(keys : list) -> dict:
+    return STORE_CACHE.get_many(keys)
 
 def store_write(key : str, val : str):
-    path = store_path()
-    items = store_reads()
-    items[key] = val.replace('\n', '')
-    with open(path, 'w') as fp:
-        fp.write("\n".join([f"{x}:{items[x]}" for x in items]))
+    STORE_CACHE.set_many({key: val})
+
+def store_write_many(items : dict):
+    STORE_CACHE.set_many(items)
+
+def store_flush():
+    STORE_CACHE.flush()
     
 def store_or_file_config(key : str) -> bool:
-    if os.path.exists(os.path.join(get_theme_path(), key.upper())):
+    if STORE_CACHE.has_flag_file(key):
         return True
     
     read = store_read(key)
-    return read == "True" or read == "1"
\ No newline at end of file
+    return read == "True" or read == "1"
@@ -1,22 +1,28 @@
 import os, json, asyncio, sys, time
 from os import path, mkdir
+from concurrent.futures import ThreadPoolExecutor
 
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 
 sys.path.append(os.path.dirname(__file__))
 
-from css_utils import Log, create_dir, create_steam_symlink, Result, get_user_home, get_theme_path, store_read as util_store_read, store_write as util_store_write, FLAG_KEEP_DEPENDENCIES, FLAG_PRESET, store_or_file_config
-from css_inject import Inject, ALL_INJECTS
+from css_utils import Log, create_dir, create_steam_symlink, Result, get_user_home, get_theme_path, store_read as util_store_read, store_write as util_store_write, store_read_many, store_write_many, store_flush, FLAG_KEEP_DEPENDENCIES, FLAG_PRESET, store_or_file_config, theme_index_path, emit_event
+from css_inject import Inject, ALL_INJECTS, CSS_FILE_CACHE
 from css_theme import Theme, CSS_LOADER_VER
 from css_themepatch import ThemePatch
+from css_themeindex import ThemeIndex
+from css_dependencies import DependencyGraph
+from css_themeregistry import ThemeRegistry
+from css_themestate import THEME_STATE
 from css_remoteinstall import install
 
 from css_server import start_server
-from css_browserhook import initialize, remove_all, commit_all
+from css_browserhook import initialize, remove_all, commit_all, compile_tab_patterns
 
 ALWAYS_RUN_SERVER = False
 IS_STANDALONE = False
+PARSE_WORKERS = 8 # Parsing threads only overlap file I/O, json parsing and Theme construction still hold the GIL
 
 try:
     if not store_or_file_config("no_redirect_logs"):
@@ -30,20 +36,49 @@ class FileChangeHandler(FileSystemEventHandler):
     def __init__(self, plugin, loop):
         self.plugin = plugin
         self.loop = loop
-        self.last = 0
-        self.delay = 1
+        self.delay = 0.25
+        self.pending = set()
+        self.flush_handle = None
 
     def on_modified(self, event):
-        #Log(f"FS Event: {event}")
+        self.on_path_changed(event.src_path, event.is_directory)
 
-        if (not (event.src_path.endswith(".css") or event.src_path.endswith("theme.json"))) or event.is_directory:
+    def on_created(self, event):
+        self.on_path_changed(event.src_path, event.is_directory)
+
+    def on_moved(self, event):
+        # Editors that save atomically write a temp file and move it over the original
+        self.on_path_changed(event.dest_path, event.is_directory)
+
+    def on_path_changed(self, src_path : str, is_directory : bool):
+        #Log(f"FS Event: {src_path}")
+
+        if (not (src_path.endswith(".css") or src_path.endswith("theme.json"))) or is_directory:
             #Log("FS Event is not on a CSS file. Ignoring!")
             return
 
-        if ((self.last + self.delay) < time.time() and not self.plugin.busy):
-            self.last = time.time()
-            Log("Reloading themes due to FS event")
-            self.loop.create_task(self.plugin.reset(self.plugin))
+        # Watchdog calls us from its own thread
+        self.loop.call_soon_threadsafe(self.queue_path, src_path)
+
+    def queue_path(self, src_path : str):
+        self.pending.add(src_path)
+
+        if self.flush_handle != None:
+            self.flush_handle.cancel()
+
+        self.flush_handle = self.loop.call_later(self.delay, self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+
+        if self.plugin.busy:
+            self.flush_handle = self.loop.call_later(self.delay, self.flush)
+            return
+
+        paths = list(self.pending)
+        self.pending = set()
+        Log(f"Reloading {len(paths)} changed file(s) due to FS events")
+        self.loop.create_task(self.plugin._hot_reload(self.plugin, paths))
         
 
 class Plugin:
@@ -112,84 +147,64 @@ class Plugin:
             return Result(False)
         
         if set_deps:
-            for dependency_name in theme.dependencies:
-                dependency = await self._get_theme(self, dependency_name)
-                if dependency == None:
-                    continue
+            plan = self.dependency_graph.get_enable_plan(theme.name)
+            values = self.dependency_graph.get_dependency_values(theme.name, set_deps_value)
 
-                if set_deps_value:
+            for dependency in plan[:-1]:
+                if dependency.name in values:
                     if dependency.enabled:
                         await dependency.remove()
 
-                    for dependency_patch_name in theme.dependencies[dependency_name]:
-                        dependency_patch_value = theme.dependencies[dependency_name][dependency_patch_name]
-                        for dependency_patch in dependency.patches:
-                            if dependency_patch.name == dependency_patch_name:
-                                dependency_patch.set_value(dependency_patch_value)
-
+                    for dependency_patch_name in values[dependency.name]:
+                        dependency_patch = self.registry.get_patch(dependency.name, dependency_patch_name)
+                        if dependency_patch != None:
+                            dependency_patch.set_value(values[dependency.name][dependency_patch_name])
 
-                await self._enable_theme(self, dependency)
+                await dependency.inject()
+                self.dependency_graph.update(dependency)
         
         result = await theme.inject()
+        self.dependency_graph.update(theme)
         return result
 
     async def _disable_theme(self, theme : Theme, keep_dependencies : bool) -> Result:
         if theme is None:
             return Result(False)
 
+        plan = self.dependency_graph.get_disable_plan(theme.name, keep_dependencies)
         result = await theme.remove()
+        self.dependency_graph.update(theme)
 
-        if keep_dependencies or not result.success:
+        if not result.success:
             return result
 
-        for dependency_name in theme.dependencies:
-            dependency = await self._get_theme(self, dependency_name)
-
-            if dependency == None:
-                continue
-        
-            used = False
-
-            for x in self.themes:
-                if x.enabled and dependency.name in [y for y in x.dependencies]:
-                    used = True
-                    break
-
-            if not used:
-                await self._disable_theme(self, dependency, False)
+        for dependency in plan[1:]:
+            await dependency.remove()
+            self.dependency_graph.update(dependency)
         
         return result
 
 
     async def download_theme_from_url(self, id : str, url : str) -> dict:
-        local_themes = [x.name for x in self.themes]
-        return (await install(id, url, local_themes)).to_dict()
+        local_themes = list(self.registry.by_name)
+        result = await install(id, url, local_themes)
+
+        if result.success: # One reload for the theme and all of its dependencies
+            await self.reset(self)
+
+        return result.to_dict()
 
     async def get_backend_version(self) -> int:
         return CSS_LOADER_VER
     
     async def _get_theme(self, themeName : str) -> Theme | None:
-        for x in self.themes:
-            if x.name == themeName:
-                return x
-        
-        return None
+        return self.registry.get(themeName)
 
     async def _get_patch_of_theme(self, themeName : str, patchName : str) -> ThemePatch:
-        theme = None
-        for x in self.themes:
-            if (x.name == themeName):
-                theme = x
-                break
-        
-        if theme is None:
+        if themeName not in self.registry:
             raise Exception(f"Did not find theme '{themeName}'")
         
-        themePatch = None
-        for x in theme.patches:
-            if (x.name == patchName):
-                themePatch = x
-                break
+        themePatch = self.registry.get_patch(themeName, patchName)
         
         if themePatch is None:
             raise Exception(f"Did not find patch '{patchName}' for theme '{themeName}'")
@@ -222,11 +237,7 @@ class Plugin:
         except Exception as e:
             return Result(False, str(e))
 
-        component = None
-        for x in themePatch.components:
-            if x.name == componentName:
-                component = x
-                break
+        component = self.registry.get_component(themeName, patchName, componentName)
         
         if component == None:
             return Result(False, f"Failed to find component '{componentName}'")
@@ -248,15 +259,92 @@ class Plugin:
         await self._load_stage_2(self)
         await commit_all()
         self.busy = False
+        emit_event("themes_reloaded", {})
         return Result(True).to_dict()
 
-    async def delete_theme(self, themeName : str) -> dict:
-        theme = None
+    async def _hot_reload(self, paths : list):
+        self.busy = True
 
-        for x in self.themes:
-            if x.name == themeName:
-                theme = x
-                break
+        try:
+            themesPath = get_theme_path()
+            changed = {}
+
+            for x in paths:
+                folder = os.path.relpath(x, themesPath).split(os.sep)[0]
+
+                if folder in [".", ".."]:
+                    continue
+
+                if folder not in changed:
+                    changed[folder] = []
+
+                changed[folder].append(os.path.normpath(x))
+
+            themesByFolder = {}
+            for x in self.themes:
+                themesByFolder[os.path.basename(x.themePath)] = x
+
+            for folder in changed:
+                theme = themesByFolder.get(folder)
+
+                if theme == None or len([x for x in changed[folder] if x.endswith("theme.json")]) > 0:
+                    await self._reload_theme(self, folder, theme)
+                else:
+                    await self._reload_theme_css(self, theme, changed[folder])
+
+            await commit_all()
+        except Exception as e:
+            Result(False, f"Hot reload failed: {str(e)}")
+        finally:
+            self.busy = False
+
+    async def _reload_theme_css(self, theme : Theme, paths : list):
+        reloaded = 0
+
+        for x in theme.get_all_injects():
+            if x.cssPath == "" or os.path.normpath(x.cssPath) not in paths:
+                continue
+
+            x.css = None
+            reloaded += 1
+
+            if x.enabled:
+                await x.inject()
+
+        Log(f"Hot reloaded {reloaded} css file(s) of theme {theme.name}")
+
+    async def _reload_theme(self, folder : str, oldTheme : Theme | None):
+        themePath = get_theme_path() + "/" + folder
+        newTheme = await asyncio.get_running_loop().run_in_executor(None, self._parse_theme_folder, themePath, themePath, None)
+
+        if oldTheme != None:
+            for x in oldTheme.get_all_injects():
+                await x.remove()
+
+            self.themes.remove(oldTheme)
+            self.registry.remove(oldTheme)
+            emit_event("theme_removed", {"name": oldTheme.name})
+
+        if newTheme != None:
+            if not self.registry.add(newTheme):
+                Log(f"Not hot reloading theme {newTheme.name}, a theme with that name already exists")
+                newTheme = None
+            else:
+                newTheme.load_order = oldTheme.load_order if oldTheme != None else len(self.themes)
+                self.themes.append(newTheme)
+                self.themes.sort(key=lambda d: d.name)
+
+        await self._build_dependency_graph(self)
+        await self._cache_lists(self)
+
+        if newTheme != None:
+            Log(f"Hot reloaded theme {newTheme.name}")
+            await newTheme.load()
+            self.dependency_graph.update(newTheme)
+            emit_event("theme_added", {"theme": newTheme.to_dict()})
+
+    async def delete_theme(self, themeName : str) -> dict:
+        theme = self.registry.get(themeName)
                 
         if (theme == None):
             return Result(False, f"Could not find theme {themeName}").to_dict()
@@ -266,7 +354,10 @@ class Plugin:
             return result.to_dict()
         
         self.themes.remove(theme)
+        self.registry.remove(theme)
+        await self._build_dependency_graph(self)
         await self._cache_lists(self)
+        emit_event("theme_removed", {"name": theme.name})
         return Result(True).to_dict()
 
     async def store_read(self, key : str) -> str:
@@ -276,6 +367,13 @@ class Plugin:
         util_store_write(key, val)
         return Result(True).to_dict()
 
+    async def store_read_many(self, keys : list) -> dict:
+        return store_read_many(keys)
+    
+    async def store_write_many(self, items : dict) -> dict:
+        store_write_many(items)
+        return Result(True).to_dict()
+
     async def generate_preset_theme(self, name : str) -> dict:
         try:
             deps = {}
@@ -325,88 +423,124 @@ class Plugin:
                 "dependencies": deps
             }, fp)
 
-        for x in self.themes:
-            if x.name == name: # Hotpatch preset in memory
-                Log(f"Updating dependencies for {name}: {deps}")
-                x.dependencies = deps
-                break
+        if a != None: # Hotpatch preset in memory
+            Log(f"Updating dependencies for {name}: {deps}")
+            a.dependencies = deps
+            await self._build_dependency_graph(self)
         
         return Result(True)
 
-    async def _parse_themes(self, themesDir : str, configDir : str = None):
+    @staticmethod
+    def _parse_theme_folder(themePath : str, configPath : str, index : ThemeIndex = None) -> Theme | None:
+        themeDataPath = themePath + "/theme.json"
+
+        if not os.path.isdir(themePath):
+            return None
+        
+        Log(f"Analyzing theme {os.path.basename(themePath)}")
+        
+        try:
+            stats = index.get_stats(themePath) if index != None else None
+            entry = index.get(themePath, stats) if index != None else None
+
+            if entry != None:
+                return Theme(themePath, entry["manifest"], configPath, entry)
+
+            theme = None
+            if path.exists(themeDataPath):
+                with open(themeDataPath, "r") as fp:
+                    theme = json.load(fp)
+                
+            themeData = Theme(themePath, theme, configPath)
+
+            if index != None:
+                index.put(themePath, stats, themeData.to_index_entry())
+
+            return themeData
+        except Exception as e:
+            Log(f"Exception while parsing a theme: {e}") # Couldn't properly parse everything
+            return None
+
+    async def _parse_themes(self, themesDir : str, configDir : str = None, index : ThemeIndex = None):
         if (configDir is None):
             configDir = themesDir
 
-        possibleThemeDirs = [str(x) for x in os.listdir(themesDir)]
+        loop = asyncio.get_running_loop()
+        possibleThemeDirs = sorted([str(x) for x in await loop.run_in_executor(None, os.listdir, themesDir)])
 
-        for x in possibleThemeDirs:
-            themePath = themesDir + "/" + x
-            configPath = configDir + "/" + x
-            themeDataPath = themePath + "/theme.json"
+        # Folders are parsed on a thread pool so the event loop (browser hook, server) stays responsive and the
+        # stat/read calls of different folders overlap. This doesn't scale with cores, the python side runs on one at a time.
+        # gather keeps the results in folder order, so the first theme with a given name still wins
+        with ThreadPoolExecutor(max_workers=PARSE_WORKERS) as pool:
+            results = await asyncio.gather(*[loop.run_in_executor(pool, self._parse_theme_folder, themesDir + "/" + x, configDir + "/" + x, index) for x in possibleThemeDirs])
 
-            if not os.path.isdir(themePath):
+        for themeData in results:
+            if themeData is None:
                 continue
-            
-            Log(f"Analyzing theme {x}")
-            
-            try:
-                theme = None
-                if path.exists(themeDataPath):
-                    with open(themeDataPath, "r") as fp:
-                        theme = json.load(fp)
-                    
-                themeData = Theme(themePath, theme, configPath)
 
-                if (themeData.name not in [x.name for x in self.themes]):
-                    self.themes.append(themeData)
-                    Log(f"Adding theme {themeData.name}")
-
-            except Exception as e:
-                Log(f"Exception while parsing a theme: {e}") # Couldn't properly parse everything
+            if self.registry.add(themeData):
+                self.themes.append(themeData)
+                Log(f"Adding theme {themeData.name}")
 
     async def _cache_lists(self):
         ALL_INJECTS.clear()
 
-        for x in self.themes:
+        for x in sorted(self.themes, key=lambda d: d.load_order):
             injects = x.get_all_injects()
-            ALL_INJECTS.extend(injects)
+
+            for y in injects:
+                y.priority = (x.load_order, len(ALL_INJECTS))
+                ALL_INJECTS.append(y)
+
+        compile_tab_patterns(ALL_INJECTS)
 
     async def _load(self):
         Log("Loading themes...")
         self.themes = []
+        self.registry = ThemeRegistry()
 
         themesPath = get_theme_path()
+        index = ThemeIndex(theme_index_path())
+        index.load()
+
+        await self._parse_themes(self, themesPath, None, index)
 
-        await self._parse_themes(self, themesPath)
+        index.report()
+        index.save()
+        THEME_STATE.load()
     
-    async def _set_theme_score(self, theme : Theme):
-        if theme.name not in self.scores:
-            self.scores[theme.name] = 0
+    async def _build_dependency_graph(self):
+        self.dependency_graph = DependencyGraph(self.themes)
 
-        self.scores[theme.name] += theme.priority_mod
-        
-        for x in theme.dependencies:
-            dependency = await self._get_theme(self, x)
-            if dependency is not None:
-                await self._set_theme_score(self, dependency)
-                self.scores[dependency.name] -= 1
-
-    async def _load_stage_2(self, inject_now : bool = True):
-        self.scores = {}
-        for x in self.themes:
-            await self._set_theme_score(self, x)
-        
-        Log(self.scores)
-        self.themes.sort(key=lambda d: self.scores[d.name])
+    async def _load_stage_2(self, inject_now : bool = True, commit_each : bool = False):
+        await self._build_dependency_graph(self)
+        self.themes = self.dependency_graph.get_load_order()
+        Log(f"Load order: {[x.name for x in self.themes]}")
+
+        for i, x in enumerate(self.themes):
+            x.load_order = i
+
+        await self._cache_lists(self)
 
         for x in self.themes:
             Log(f"Loading theme {x.name}")
-            await x.load(inject_now)
+
+            try:
+                await x.load(inject_now)
+            except Exception as e:
+                Result(False, f"Failed to load theme {x.name}: {str(e)}")
+
+            if commit_each:
+                await commit_all()
         
-        await self._cache_lists(self)
+        self.dependency_graph.refresh_refcounts()
+        Log(f"Css file cache: {CSS_FILE_CACHE.get_stats()}")
         self.themes.sort(key=lambda d: d.name)
 
     async def exit(self):
+        THEME_STATE.flush()
+        store_flush()
+
         try:
             import css_win_tray
             css_win_tray.stop_icon()
@@ -424,30 +558,33 @@ class Plugin:
         self.observer = None
         self.server_loaded = False
 
-        await asyncio.sleep(1)
-
         self.busy = False
         self.themes = []
+        self.registry = ThemeRegistry()
         Log("Initializing css loader...")
         Log(f"Max supported manifest version: {CSS_LOADER_VER}")
-        
+        start_time = time.time()
+
+        # Browser discovery and tab attach run while the themes are parsed, themes stream into tabs as they load
+        await initialize()
         create_steam_symlink()
 
         await self._load(self)
-        #await self._inject_test_element(self, "SP", 9999, "test_ui_loaded")
-        await self._load_stage_2(self, False)
+        Log(f"[Startup] Parsed themes in {time.time() - start_time:.3f}s")
+
+        stage_time = time.time()
+        await self._load_stage_2(self, True, True)
+        Log(f"[Startup] Loaded and injected themes in {time.time() - stage_time:.3f}s")
 
         if (store_or_file_config("watch")):
             await self.toggle_watch_state(self)
         else:
             Log("Not observing themes folder for file changes")
 
-        Log(f"Initialized css loader. Found {len(self.themes)} themes. Total {len(ALL_INJECTS)} injects, {len([x for x in ALL_INJECTS if x.enabled])} injected")
-        
         if (ALWAYS_RUN_SERVER or store_or_file_config("server")):
             await self.enable_server(self)
 
-        await initialize()
+        Log(f"Initialized css loader in {time.time() - start_time:.3f}s. Found {len(self.themes)} themes. Total {len(ALL_INJECTS)} injects, {len([x for x in ALL_INJECTS if x.enabled])} injected")
 
 if __name__ == '__main__':
     ALWAYS_RUN_SERVER = True
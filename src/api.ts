@@ -1,6 +1,6 @@
 import { ServerAPI } from "decky-frontend-lib";
 import { CssLoaderState } from "./state";
-import { toast, storeWrite, downloadThemeFromUrl, reloadBackend } from "./python";
+import { toast, storeWrite, downloadThemeFromUrl, getInstalledThemes } from "./python";
 import { ThemeQueryRequest } from "./apiTypes";
 import { generateParamStr } from "./logic";
 
@@ -243,8 +243,9 @@ export function toggleStar(themeId: string, isStarred: boolean, authToken: strin
 export async function installTheme(themeId: string) {
   const setGlobalState = globalState!.setGlobalState.bind(globalState);
   setGlobalState("isInstalling", true);
+  // The backend reloads once after installing the theme and its dependencies
   await downloadThemeFromUrl(themeId);
-  await reloadBackend();
+  await getInstalledThemes();
   setGlobalState("isInstalling", false);
   return;
 }
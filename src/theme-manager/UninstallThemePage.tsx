@@ -33,7 +33,7 @@ export const UninstallThemePage: VFC = () => {
       const id = remoteEntry.id;
       setUninstalling(true);
       python.resolve(python.downloadThemeFromUrl(id), () => {
-        python.reloadBackend();
+        python.getInstalledThemes();
         setUninstalling(false);
       });
     }